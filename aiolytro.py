@@ -0,0 +1,125 @@
+#! /usr/bin/env python3
+# asyncio client for Lytro cameras.
+# AsyncIpTarget speaks the comm_ip framing over asyncio streams. The USB and
+# SG transports block, so ExecutorTarget runs them on a thread of their own.
+# AsyncLytro mirrors the Lytro class with awaitable methods; one event loop
+# can drive any number of cameras.
+
+import asyncio
+import concurrent.futures
+import struct
+
+import lytro
+from comm_ip import magic, Response
+
+class AsyncIpTarget:
+    maxtransfer = 1<<15
+    def __init__(self, reader, writer):
+        self.reader = reader
+        self.writer = writer
+        # One command at a time per connection
+        self.lock = asyncio.Lock()
+    @classmethod
+    async def connect(cls, address, timeout=1):
+        reader, writer = await asyncio.wait_for(asyncio.open_connection(*address), timeout)
+        return cls(reader, writer)
+    async def close(self):
+        self.writer.close()
+        await self.writer.wait_closed()
+    async def response(self, command):
+        header = await self.reader.readexactly(3*4+len(command))
+        response = Response(*struct.unpack(b'<3IB', header[:13]))
+        assert response.magic == magic
+        assert response.command == command[0]
+        return response
+    async def read(self, command, size):
+        buf = bytearray(min(size, self.maxtransfer))
+        return buf[:await self.readinto(command, buf)]
+    async def readinto(self, command, buf):
+        size = min(len(buf), self.maxtransfer)
+        async with self.lock:
+            self.writer.write(struct.pack(b'<3I', magic, size, 1)+command)
+            await self.writer.drain()
+            response = await self.response(command)
+            assert response.size <= size, f"Oversized response: {response!r}"
+            buf[:response.size] = await self.reader.readexactly(response.size)
+        return response.size
+    async def write(self, command, data):
+        async with self.lock:
+            self.writer.write(struct.pack(b'<3I', magic, len(data), 0)+command+data)
+            await self.writer.drain()
+            response = await self.response(command)
+            assert response.seq == 2
+            # tcp proto mirrors our output
+            await self.reader.readexactly(len(data))
+
+class ExecutorTarget:
+    "Run a blocking lytro.Target on its own thread"
+    def __init__(self, target):
+        self.target = target
+        # A single worker keeps commands to the device in order
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+    def run(self, function, *args):
+        return asyncio.get_running_loop().run_in_executor(self.executor, function, *args)
+    async def read(self, command, size):
+        return await self.run(self.target.read, command, size)
+    async def readinto(self, command, buf):
+        return await self.run(self.target.readinto, command, buf)
+    async def write(self, command, data):
+        return await self.run(self.target.write, command, data)
+    async def close(self):
+        self.executor.shutdown()
+
+class AsyncLytro:
+    def __init__(self, comm):
+        self.comm = comm
+        # Downloads are load/query/download sequences; don't let them interleave
+        self.lock = asyncio.Lock()
+    async def send(self, packet):
+        command = packet.pack()
+        if packet.payload:
+            await self.comm.write(command, packet.payload.ljust(packet.length, b'\0'))
+            return None
+        return packet.decode(command, await self.comm.read(command, packet.length))
+    async def getbattery(self):
+        return (await self.send(lytro.LytroQueryBattery())).percent()
+    async def gettime(self):
+        return (await self.send(lytro.LytroQueryTime())).datetime()
+    async def download(self, loadtype, name=None, subtype=None):
+        async with self.lock:
+            await self.send(lytro.loadpacket(loadtype, name, subtype))
+            size = (await self.send(lytro.LytroQuerySize())).size()
+            if size==0:
+                raise FileNotFoundError(name)
+            data = bytearray(size)
+            view = memoryview(data)
+            dl = lytro.LytroDownload(size)
+            empties = 0
+            while dl.offset < size:
+                received = await self.comm.readinto(dl.pack(), view[dl.offset:])
+                if not received:
+                    empties += 1
+                    if empties >= lytro.maxempty:
+                        raise IOError(f"No data at offset {dl.offset} after {empties} tries")
+                    continue
+                empties = 0
+                dl.offset += received
+            return data
+    async def gethardwareinfo(self):
+        return lytro.HardwareInfo(await self.download('hardware_info'))
+    async def getpicturelist(self):
+        return lytro.PictureList(await self.download('picture_list'))
+
+if __name__=='__main__':
+    import comm_ip
+
+    async def poll(address):
+        dev = AsyncLytro(await AsyncIpTarget.connect(address))
+        battery, time = await asyncio.gather(dev.getbattery(), dev.gettime())
+        print(f"{address}: battery {battery}, time {time}")
+        await dev.comm.close()
+
+    async def main():
+        await asyncio.gather(*(poll(address) for address in comm_ip.probe()))
+
+    asyncio.run(main())
@@ -0,0 +1,152 @@
+#! /usr/bin/env python3
+# Download throughput benchmarks against the emulator (emulator.py), so
+# transport and download performance can be tracked without a camera.
+# Each benchmark reports MB/s, per chunk latency from stats.StatsTarget and
+# the peak of Python allocations from tracemalloc. With --json the results
+# are also written out. For CI, --save-baseline records a run together with
+# its link settings, and --check reruns those settings and exits non-zero
+# if any download's MB/s falls more than --tolerance below the baseline:
+#   python bench.py --check bench-baseline.json
+
+import json
+import struct
+import time
+import timeit
+import tracemalloc
+
+import comm_ip
+import emulator
+import lytro
+import stats
+
+def measure(function):
+    "Run function, returning (result, seconds, peak bytes allocated)"
+    tracemalloc.start()
+    start = time.perf_counter()
+    try:
+        result = function()
+        elapsed = time.perf_counter()-start
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+    return result, elapsed, peak
+
+def bench(name, dev, function, size=None, repeat=3):
+    "Best of repeat runs of function on dev, with its command stats"
+    best = None
+    for i in range(repeat):
+        transportstats = stats.instrument(dev)
+        try:
+            result, elapsed, peak = measure(function)
+        finally:
+            dev.comm = dev.comm.target
+        if best is None or elapsed < best[0]:
+            best = elapsed, peak, transportstats.snapshot(), result
+    elapsed, peak, snapshot, result = best
+    if size is None:
+        size = len(result) if isinstance(result, (bytes, bytearray)) else 0
+    download = snapshot['commands'].get('download', {})
+    return {'name': name, 'seconds': elapsed, 'bytes': size,
+            'MB/s': size/elapsed/1e6 if size else None,
+            'chunks': download.get('count', 0),
+            'chunk p50 ms': download.get('p50', 0)*1e3, 'chunk p99 ms': download.get('p99', 0)*1e3,
+            'peak alloc': peak, 'retries': snapshot['retries']}
+
+def run(link=None, windows=(1, 4), repeat=3, pictures=3):
+    results = []
+    camera = emulator.Camera(pictures)
+    with emulator.Emulator(camera, link) as server:
+        for window in windows:
+            dev = lytro.Lytro(comm_ip.IpTarget(server.address, timeout=10, window=window))
+            picture = camera.ids[0]
+            tag = f"window {window}"
+            for subtype in ('jpg', 'raw', 'txt', '128'):
+                results.append(bench(f"download {subtype}, {tag}", dev,
+                                     lambda: dev.download('picture', picture, subtype, verbose=False), repeat=repeat))
+            size = len(camera.files[lytro.loadtypes['picture'], picture+chr(lytro.picturesubtypes.index('raw'))])
+            def streamed():
+                for chunk in dev.iterdownload('picture', picture, 'raw', verbose=False):
+                    pass
+            results.append(bench(f"iterdownload raw, {tag}", dev, streamed, size, repeat))
+            results.append(bench(f"getpicturelist, {tag}", dev,
+                                 lambda: dev.getpicturelist(verbose=False), 0, repeat))
+            results.append(bench(f"getbattery, {tag}", dev, dev.getbattery, 0, repeat))
+            results.append(bench(f"gettime, {tag}", dev, dev.gettime, 0, repeat))
+            dev.comm.s.close()
+    return results
+
+def codec(number=100000):
+    "Microseconds per packet to encode download commands, and to encode and decode queries"
+    dl = lytro.LytroDownload(1<<24)
+    def download():
+        dl.offset += 1
+        return dl.pack()
+    query = lytro.LytroQueryBattery()
+    payload = struct.pack('<f', 50.0)
+    def battery():
+        return query.decode(query.pack(), payload).percent()
+    return {name: min(timeit.repeat(function, number=number, repeat=3))/number*1e6
+            for name, function in (('download encode', download), ('query round trip', battery))}
+
+def regressions(results, baseline, tolerance=0.3):
+    "(name, baseline MB/s, MB/s) for each result slower than baseline by more than tolerance"
+    before = {r['name']: r['MB/s'] for r in baseline['results'] if r['MB/s']}
+    return [(r['name'], before[r['name']], r['MB/s'] or 0.0) for r in results
+            if r['name'] in before and (r['MB/s'] or 0.0) < before[r['name']]*(1-tolerance)]
+
+def report(results):
+    print(f"{'benchmark':28} {'MB/s':>8} {'ms':>8} {'chunks':>6} {'p50 ms':>7} {'p99 ms':>7} {'peak KiB':>9}")
+    for r in results:
+        mbs = f"{r['MB/s']:8.1f}" if r['MB/s'] else f"{'':8}"
+        print(f"{r['name']:28} {mbs} {r['seconds']*1e3:8.2f} {r['chunks']:6} "
+              f"{r['chunk p50 ms']:7.3f} {r['chunk p99 ms']:7.3f} {r['peak alloc']/1024:9.0f}"
+              + (f" retries {r['retries']}" if r['retries'] else ''))
+
+def main(argv=None):
+    "Command line entry point. Returns the exit status: 1 if --check found a regression."
+    import argparse
+    parser = argparse.ArgumentParser(description='Benchmark downloads against the Lytro emulator.')
+    parser.add_argument('--latency', type=float, default=0.0, help='Link latency in ms')
+    parser.add_argument('--bandwidth', type=float, help='Link bandwidth in MB/s')
+    parser.add_argument('--short', type=float, default=0.0, help='Probability of a short download reply')
+    parser.add_argument('--empty', type=float, default=0.0, help='Probability of an empty download reply')
+    parser.add_argument('--windows', default='1,4', help='Pipelining windows to compare (comma separated)')
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--json', type=argparse.FileType('w'), help='Also write the results here')
+    parser.add_argument('--save-baseline', metavar='FILE', help='Write the results and link settings as a baseline')
+    parser.add_argument('--check', metavar='FILE',
+                        help='Rerun with the link settings of this baseline; fail on a throughput regression')
+    parser.add_argument('--tolerance', type=float, default=0.3,
+                        help='Fraction of baseline MB/s a download may lose before --check fails')
+    parser.add_argument('--codec', action='store_true', help='Only time packet encoding and decoding')
+    args = parser.parse_args(argv)
+    if args.codec:
+        for name, us in codec().items():
+            print(f"{name:28} {us:8.3f} us/packet")
+        return 0
+    settings = {'latency': args.latency, 'bandwidth': args.bandwidth, 'short': args.short,
+                'empty': args.empty, 'windows': args.windows, 'repeat': args.repeat}
+    baseline = None
+    if args.check:
+        with open(args.check) as f:
+            baseline = json.load(f)
+        settings = baseline['settings']
+    link = emulator.Link(settings['latency']/1e3, settings['bandwidth'] and settings['bandwidth']*1e6,
+                         settings['short'], settings['empty'])
+    results = run(link, [int(window) for window in settings['windows'].split(',')], settings['repeat'])
+    report(results)
+    if args.json:
+        with args.json as f:
+            json.dump(results, f, indent=1)
+    if args.save_baseline:
+        with open(args.save_baseline, 'w') as f:
+            json.dump({'settings': settings, 'results': results}, f, indent=1)
+    if baseline is not None:
+        slower = regressions(results, baseline, args.tolerance)
+        for name, before, now in slower:
+            print(f"Regression: {name}: {now:.1f} MB/s, baseline {before:.1f} MB/s")
+        return 1 if slower else 0
+    return 0
+
+if __name__=='__main__':
+    raise SystemExit(main())
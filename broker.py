@@ -0,0 +1,353 @@
+#! /usr/bin/env python3
+# Camera broker: a long running process that owns a camera's Target and
+# serves any number of local clients over a Unix socket. Clients use
+# BrokerTarget, which Lytro takes like any other Target, so they skip the
+# connect, USB reset and discovery cost, and don't fight over the camera.
+#
+# Commands from all clients go through one Dispatcher, so they're
+# serialized (and pipelined, if the transport can). Loading a file and
+# downloading it is a session: a client holds the camera from its load
+# until its transfer is done (Lytro does this through BrokerTarget.session).
+# Battery and time queries don't touch the loaded file and go in between.
+#
+# Hardware info is cached for good, the picture list for as long as its
+# size doesn't change (checked at most every listttl seconds); clients
+# loading either are served from the cache without a download.
+#
+# Wire format, client to broker: op, size, 16 byte command, then size bytes
+# for writes. Broker to client: ok, size, then the reply or an error message.
+
+import collections
+import os
+import queue
+import socket
+import socketserver
+import struct
+import threading
+import time
+
+import lytro
+
+defaultpath = os.path.join(os.environ.get('XDG_RUNTIME_DIR') or os.path.join(os.path.expanduser('~'), '.cache', 'pyly'),
+                           'pyly-broker.sock')
+
+READ, WRITE, LOCK, UNLOCK = range(1, 5)
+request = struct.Struct('<BI16s')
+reply = struct.Struct('<BI')
+hello = struct.Struct('<2I')
+
+# Queries that don't depend on the loaded file
+stateless = {lytro.LytroQueryBattery.query, lytro.LytroQueryTime.query}
+
+def recvinto(s, view):
+    "Fill all of view from socket s"
+    received = 0
+    while received < len(view):
+        n = s.recv_into(view[received:])
+        if not n:
+            raise IOError("Connection closed")
+        received += n
+
+def stale(path):
+    "Whether path is a socket left behind by a broker that's gone"
+    s = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        s.connect(path)
+    except ConnectionRefusedError:
+        return True
+    except OSError:
+        return False
+    finally:
+        s.close()
+    return False
+
+class Handler(socketserver.BaseRequestHandler):
+    "One client connection"
+    def handle(self):
+        broker = self.server.broker
+        self.depth = 0          # session locks held
+        self.cached = None      # file served from the broker cache since the last load
+        try:
+            self.request.sendall(hello.pack(broker.target.maxtransfer or 0, broker.target.window))
+        except OSError:
+            # Gone already, e.g. stale() checking whether we're alive
+            return
+        replies = queue.Queue()
+        writer = threading.Thread(target=self.write, args=(replies,), daemon=True)
+        writer.start()
+        header = bytearray(request.size)
+        try:
+            while True:
+                try:
+                    recvinto(self.request, memoryview(header))
+                except IOError:
+                    break
+                op, size, command = request.unpack(header)
+                data = None
+                if op == WRITE:
+                    data = bytearray(size)
+                    recvinto(self.request, memoryview(data))
+                try:
+                    replies.put(self.dispatch(broker, op, size, command, data))
+                except Exception as e:
+                    replies.put(e)
+        finally:
+            replies.put(None)
+            writer.join()
+            while self.depth:
+                self.depth -= 1
+                broker.lock.release()
+    def dispatch(self, broker, op, size, command, data):
+        "Start a request. Returns its reply: bytes, or (buffer, future of its size)."
+        if op == LOCK:
+            broker.lock.acquire()
+            self.depth += 1
+            return b''
+        if op == UNLOCK:
+            # Let the session's commands finish before someone else loads a file
+            broker.drain()
+            self.depth -= 1
+            broker.lock.release()
+            return b''
+        if command[0] == lytro.LytroQuery.command and command[2] in stateless:
+            return broker.submit(command, size)
+        with broker.lock:
+            if command[0] == lytro.LytroLoad.command:
+                self.cached = broker.cachedfile(command[2]) if op == READ else None
+                if self.cached is not None:
+                    return b''
+            elif self.cached is not None:
+                if command[0] == lytro.LytroQuery.command and command[2] == lytro.LytroQuerySize.query:
+                    return struct.pack('<I', len(self.cached))
+                if command[0] == lytro.LytroDownload.command:
+                    offset, = struct.unpack_from('<I', command, 3)
+                    return self.cached[offset:offset+min(size, broker.target.maxtransfer or size)]
+            if op == WRITE:
+                pending = broker.submitwrite(command, data)
+            else:
+                pending = broker.submit(command, size)
+            if self.depth == 0:
+                # Outside a session, the command is a session of its own
+                pending[1].result()
+            return pending
+    def write(self, replies):
+        "Send replies in request order as they complete"
+        while True:
+            item = replies.get()
+            if item is None:
+                break
+            ok = 1
+            try:
+                if isinstance(item, Exception):
+                    raise item
+                if isinstance(item, tuple):
+                    buf, future = item
+                    received = future.result()
+                    payload = b'' if buf is None else memoryview(buf)[:received]
+                else:
+                    payload = item
+            except Exception as e:
+                # Camera errors are IOErrors too; they go to the client, only socket errors end the connection
+                ok = 0
+                payload = f"{type(e).__name__}: {e}".encode('utf-8', 'replace')
+            try:
+                self.request.sendall(reply.pack(ok, len(payload)))
+                self.request.sendall(payload)
+            except OSError:
+                break
+
+class Broker(socketserver.ThreadingUnixStreamServer):
+    daemon_threads = True
+    def __init__(self, target, path=defaultpath, listttl=5.0):
+        # A live broker's socket is left alone, so binding fails
+        if stale(path):
+            os.unlink(path)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # Unset if binding fails, so server_close leaves another broker's socket alone
+        self.path = self.dispatcher = None
+        super().__init__(path, Handler)
+        self.broker = self
+        self.path = path
+        self.target = target
+        self.dispatcher = lytro.Dispatcher(target)
+        # Held by the client whose session it is; the broker's own fetches nest inside
+        self.lock = threading.RLock()
+        self.dev = lytro.Lytro(self.dispatcher)
+        self.dev.lock = self.lock
+        self.listttl = listttl
+        self.hardwareinfo = None
+        self.picturelist = None   # (data, checked at)
+        self.last = None
+    def submit(self, command, size):
+        "Queue a read for the camera. Returns (buffer, future of bytes received)."
+        buf = bytearray(min(size, self.target.maxtransfer or size))
+        tag, future = self.dispatcher.submit('readinto', command, buf)
+        self.last = future
+        return buf, future
+    def submitwrite(self, command, data):
+        "Queue a write for the camera. Returns (None, future)."
+        tag, future = self.dispatcher.submit('write', command, bytes(data))
+        self.last = future
+        return None, future
+    def drain(self):
+        "Wait for the commands queued so far"
+        if self.last is not None:
+            try:
+                self.last.result()
+            except Exception:
+                pass
+    def cachedfile(self, sort):
+        "Whole file for loads the broker caches, or None to pass the load on"
+        if sort == lytro.loadtypes['hardware_info']:
+            if self.hardwareinfo is None:
+                self.hardwareinfo = self.dev.download('hardware_info', verbose=False)
+            return self.hardwareinfo
+        if sort == lytro.loadtypes['picture_list']:
+            now = time.monotonic()
+            if self.picturelist is not None:
+                data, checked = self.picturelist
+                if now-checked < self.listttl:
+                    return data
+                # A new or deleted picture changes the size; that's all we can cheaply see
+                if self.dev.load('picture_list') == len(data):
+                    self.picturelist = data, now
+                    return data
+            self.picturelist = self.dev.download('picture_list', verbose=False), now
+            return self.picturelist[0]
+        return None
+    def server_close(self):
+        super().server_close()
+        if self.dispatcher is not None:
+            self.dispatcher.close()
+        if self.path is not None and os.path.exists(self.path):
+            os.unlink(self.path)
+
+class Session:
+    "Reentrant lock on the camera, shared between a client's threads"
+    def __init__(self, target):
+        self.target = target
+        self.lock = threading.RLock()
+        self.depth = 0
+    def acquire(self):
+        self.lock.acquire()
+        self.depth += 1
+        if self.depth == 1:
+            self.target.request(LOCK)
+    def release(self):
+        self.depth -= 1
+        try:
+            if self.depth == 0:
+                self.target.request(UNLOCK)
+        finally:
+            self.lock.release()
+    def __enter__(self):
+        self.acquire()
+        return self
+    def __exit__(self, *exc):
+        self.release()
+
+class BrokerTarget(lytro.Target):
+    """Target talking to a Broker. Replies come back in request order, so
+    whichever thread needs a reply receives those queued before it too,
+    into their own buffers; no thread holds the socket while it waits."""
+    def __init__(self, path=defaultpath, timeout=10):
+        self.s = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.s.settimeout(timeout)
+        self.s.connect(path)
+        self.io = threading.Lock()          # sending
+        self.receiving = threading.Lock()
+        self.queued = collections.deque()   # [buf, result, done] per reply not received yet
+        self.header = bytearray(reply.size)
+        info = bytearray(hello.size)
+        recvinto(self.s, memoryview(info))
+        maxtransfer, self.window = hello.unpack(info)
+        self.maxtransfer = maxtransfer or None
+        # Lytro holds this from load until the transfer is done
+        self.session = Session(self)
+    def send(self, op, command=bytes(16), size=0, data=b''):
+        self.s.sendall(request.pack(op, size, command) + data)
+    def receive(self, buf=None):
+        "Receive a reply, into buf if given. Returns its size, or the reply itself."
+        recvinto(self.s, memoryview(self.header))
+        ok, size = reply.unpack(self.header)
+        if not ok or buf is None or size > len(buf):
+            data = bytearray(size)
+            recvinto(self.s, memoryview(data))
+            if not ok:
+                raise IOError(f"Broker: {data.decode('utf-8', 'replace')}")
+            assert buf is None, f"Oversized reply: {size}"
+            return data
+        recvinto(self.s, memoryview(buf)[:size])
+        return size
+    def submit(self, op, command=bytes(16), size=0, data=b'', buf=None):
+        "Send a request. Returns its reply slot, for wait."
+        slot = [buf, None, False]
+        with self.io:
+            self.send(op, command, size, data)
+            self.queued.append(slot)
+        return slot
+    def wait(self, slot):
+        "Receive replies up to slot's. Returns its result, or raises its error."
+        with self.receiving:
+            while not slot[2]:
+                head = self.queued.popleft()
+                try:
+                    head[1] = self.receive(head[0])
+                except (IOError, AssertionError) as e:
+                    # Error replies are read whole, so the next one still lines up
+                    head[1] = e
+                head[2] = True
+        if isinstance(slot[1], Exception):
+            raise slot[1]
+        return slot[1]
+    def request(self, op):
+        self.wait(self.submit(op))
+    def read(self, command, size):
+        return self.wait(self.submit(READ, command, size))
+    def readinto(self, command, buf):
+        return self.wait(self.submit(READ, command, len(buf), buf=buf))
+    def write(self, command, data):
+        self.wait(self.submit(WRITE, command, len(data), bytes(data)))
+    def readmany(self, requests):
+        "Keep up to window reads queued at the broker; replies come back in order"
+        requests = iter(requests)
+        pending = collections.deque()
+        try:
+            while True:
+                while len(pending) < self.window:
+                    request = next(requests, None)
+                    if request is None:
+                        break
+                    pending.append((request, self.submit(READ, request[0], len(request[1]), buf=request[1])))
+                if not pending:
+                    return
+                request, slot = pending.popleft()
+                yield request, self.wait(slot)
+        finally:
+            # Let replies still on their way land now, not in buffers the caller has moved on from
+            for request, slot in pending:
+                try:
+                    self.wait(slot)
+                except (IOError, AssertionError):
+                    pass
+
+def connect(path=defaultpath):
+    "Lytro using the broker at path"
+    return lytro.Lytro(BrokerTarget(path))
+
+if __name__=='__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description='Share a Lytro camera between local clients.')
+    parser.add_argument('--socket', default=defaultpath, help='Unix socket to serve on')
+    parser.add_argument('--list-ttl', type=float, default=5.0,
+                        help='Seconds before checking whether the picture list has changed')
+    args = parser.parse_args()
+    if os.path.exists(args.socket) and not stale(args.socket):
+        raise SystemExit(f"A broker is already serving {args.socket}")
+    dev = lytro.connect()
+    broker = Broker(dev.comm, args.socket, args.list_ttl)
+    print(f"Serving {type(dev.comm).__name__} on {args.socket}")
+    try:
+        broker.serve_forever()
+    finally:
+        broker.server_close()
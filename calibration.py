@@ -0,0 +1,100 @@
+# Camera calibration data and a local store of it per camera serial.
+# The calibration download is several MB, and parsing it is not free either,
+# so a camera's calibration is fetched once and kept as the raw blob next to
+# a JSON index of what was parsed from it, which names the blob. Loading
+# memory maps the blob.
+# Calibration files are LFP containers (see lfp.py); JSON sections are
+# parsed, other sections are left as views of the blob.
+
+import glob
+import hashlib
+import json
+import mmap
+import os
+import struct
+
+import lfp
+
+defaultdir = os.path.join(os.path.expanduser('~'), '.cache', 'pyly', 'calibration')
+
+class Calibration:
+    def __init__(self, data, sections=None, metadata=None):
+        self.data = data
+        if sections is None:
+            sections, metadata = self.parse(data)
+        self.sections = sections
+        # sha1 ref -> parsed JSON
+        self.metadata = metadata
+    @staticmethod
+    def parse(data):
+        try:
+            sections = list(lfp.scan(data))
+        except (ValueError, struct.error, UnicodeDecodeError):
+            # Not in a format we know; keep the blob as it is
+            return [], {}
+        metadata = {}
+        view = memoryview(data)
+        for section in sections:
+            chunk = view[section.offset:section.offset+section.length]
+            if chunk[:1] == b'{':
+                try:
+                    metadata[section.ref] = json.loads(bytes(chunk))
+                except ValueError:
+                    pass
+        return sections, metadata
+    def section(self, ref):
+        "Zero-copy view of a calibration section"
+        for section in self.sections:
+            if section.ref == ref:
+                return memoryview(self.data)[section.offset:section.offset+section.length]
+        raise KeyError(ref)
+    def find(self, key):
+        "First value for key in any of the calibration metadata"
+        import rawview
+        for meta in self.metadata.values():
+            found = rawview.find(meta, key)
+            if found is not None:
+                return found
+        return None
+    def __str__(self):
+        return f"{len(self.data)} bytes, {len(self.sections)} sections, {len(self.metadata)} JSON"
+
+class CalibrationStore:
+    "Calibration per HardwareInfo.serial"
+    def __init__(self, directory=defaultdir):
+        self.directory = directory
+    def path(self, serial):
+        return os.path.join(self.directory, serial.hex())
+    def get(self, serial):
+        "Stored calibration for serial (bytes), or None"
+        path = self.path(serial)
+        try:
+            with open(path+'.json') as f:
+                index = json.load(f)
+            sections = [lfp.Section(*section) for section in index['sections']]
+            metadata = index['metadata']
+            with open(os.path.join(self.directory, os.path.basename(index['blob'])), 'rb') as f:
+                size = os.fstat(f.fileno()).st_size
+                if size != index['size']:
+                    return None
+                data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) if size else b''
+        except (OSError, ValueError, KeyError, TypeError):
+            return None
+        return Calibration(data, sections, metadata)
+    def put(self, serial, calibration):
+        os.makedirs(self.directory, exist_ok=True)
+        path = self.path(serial)
+        # Each blob gets a name of its own, and the index switches to it last,
+        # so the index in place always describes the blob it names
+        blob = f"{serial.hex()}-{hashlib.sha1(calibration.data).hexdigest()[:16]}.cal"
+        with open(os.path.join(self.directory, blob+'.tmp'), 'wb') as f:
+            f.write(calibration.data)
+        os.replace(os.path.join(self.directory, blob+'.tmp'), os.path.join(self.directory, blob))
+        with open(path+'.json.tmp', 'w') as f:
+            json.dump({'blob': blob, 'size': len(calibration.data),
+                       'sections': [list(section) for section in calibration.sections],
+                       'metadata': calibration.metadata}, f)
+        os.replace(path+'.json.tmp', path+'.json')
+        for old in glob.glob(glob.escape(path)+'*.cal'):
+            if os.path.basename(old) != blob:
+                os.remove(old)
@@ -8,44 +8,122 @@ from collections import namedtuple
 import lytro
 
 magic = 0xfaaa55af
+prefix = struct.Struct('<3I')
 Response = namedtuple('Response', ['magic', 'size', 'seq', 'command'])
 
 class IpTarget(lytro.Target):
-    def __init__(self, address, timeout=1):
+    def __init__(self, address, timeout=1, window=1):
+        self.address = address
+        self.timeout = timeout
         self.s = socket.create_connection(address, timeout)
         self.s.settimeout(timeout)
+        # Download commands kept in flight by readmany; dropped to 1 if a
+        # pipelined download fails
+        self.window = window
+        # Reused for the framing of every read command
+        self.frame = bytearray(prefix.size+16)
+    maxtransfer = 1<<15
+    # Candidates for tuning.TunedTarget
+    transfersizes = (1<<14, 1<<15, 1<<16)
+    def reconnect(self):
+        "Start over on a new connection, dropping the replies the old one had coming"
+        self.s.close()
+        self.s = socket.create_connection(self.address, self.timeout)
+        self.s.settimeout(self.timeout)
+    def recvinto(self, view):
+        "Fill all of view from the socket"
+        received = 0
+        while received < len(view):
+            n = self.s.recv_into(view[received:])
+            if not n:
+                raise IOError("Connection closed")
+            received += n
     def read(self, command, size):
-        maxsize = 1<<15
-        if size > maxsize:
-            size = maxsize
-        prefix=struct.pack(b'<3I', magic, size, 1)
-        self.s.send(prefix+command)
+        buf = bytearray(min(size, self.maxtransfer))
+        return buf[:self.readinto(command, buf)]
+    def sendread(self, command, size):
+        prefix.pack_into(self.frame, 0, magic, size, 1)
+        self.frame[prefix.size:] = command
+        self.s.sendall(self.frame)
+    def readinto(self, command, buf):
+        size = min(len(buf), self.maxtransfer)
+        self.sendread(command, size)
         #print(f"{command!r}")
         assert 3*4+len(command)==28
-        response_s=self.s.recv(3*4+len(command))
+        response_s=bytearray(3*4+len(command))
+        self.recvinto(memoryview(response_s))
         #print(repr(response_s), b2a_hex(response_s))
         response=Response(*struct.unpack(b'<3IB', response_s[:13]))
         # Check that the response does match
         #print(f"Response: {response!r} {response_s!r}")
         assert response.magic == magic
         assert response.command == command[0]
-        payload=self.s.recv(response.size)
-        while len(payload)<response.size:
-            #print(f"{len(payload)=}")
-            payload+=self.s.recv(response.size-len(payload))
-        return payload
+        assert response.size <= size, f"Oversized response: {response!r}"
+        self.recvinto(memoryview(buf)[:response.size])
+        return response.size
+    def readmany(self, requests):
+        """Pipelined readinto. Keeps up to self.window commands in flight and
+        places each response by the command it echoes, falling back on stream order."""
+        requests = iter(requests)
+        pending = []    # in send order
+        header = bytearray(3*4+16)
+        try:
+            while True:
+                while len(pending) < self.window:
+                    request = next(requests, None)
+                    if request is None:
+                        break
+                    command, buf = request[0], request[1]
+                    size = min(len(buf), self.maxtransfer)
+                    self.sendread(command, size)
+                    pending.append(request)
+                if not pending:
+                    return
+                self.recvinto(memoryview(header))
+                response=Response(*struct.unpack(b'<3IB', header[:13]))
+                assert response.magic == magic
+                # Oldest request with the echoed command; if the echo doesn't
+                # identify one, TCP keeps replies in order
+                echo = bytes(header[12:])
+                match = next((i for i, request in enumerate(pending) if request[0] == echo), 0)
+                request = pending.pop(match)
+                assert response.command == request[0][0]
+                buf = memoryview(request[1])
+                assert response.size <= len(buf), f"Oversized response: {response!r}"
+                self.recvinto(buf[:response.size])
+                yield request, response.size
+        except GeneratorExit:
+            if pending:
+                # Abandoned with replies in flight; they'd be taken for the next commands'
+                self.reconnect()
+            raise
+        except (IOError, AssertionError):
+            if pending:
+                # Where the stream stands is anyone's guess; start clean, and
+                # don't pipeline again on this connection
+                self.retried('reconnect')
+                self.window = 1
+                self.reconnect()
+            raise
     def write(self, command, data):
         prefix=struct.pack(b'<3I', magic, len(data), 0)
         self.s.send(prefix+command+data)
-        print(f"{3*4+len(command)=}")
+        #print(f"{3*4+len(command)=}")
         response=self.s.recv(3*4+len(command))
-        print(repr(response), b2a_hex(response))
+        #print(repr(response), b2a_hex(response))
         # Check that the response does match
         #print(f"Response: {response!r}")
         assert response[:3*4+1]==struct.pack(b'<3IB', magic, len(data), 2, command[0])
         self.s.recv(len(data))    # Read any response data; tcp proto mirrors our output
         return response[3*4+len(command):]
 
+def devicepath(address):
+    return f"{address[0]}:{address[1]}"
+
+def opendevice(path):
+    host, port = path.rsplit(':', 1)
+    return IpTarget((host, int(port)))
+
 def probe():
     # TODO: Check if it's actually there? DNS-SD should be used. 
     return [("10.100.1.1", 5678)]
@@ -5,7 +5,7 @@
 # However, this isn't perfectly stable yet; attempting a download (e.g. list pictures)
 # sometimes causes the camera to crash and restart. Usually works after that, though. 
 
-import glob, posix, fcntl, struct, time
+import glob, posix, fcntl, itertools, select, struct, time
 from ctypes import *
 import lytro
 
@@ -50,48 +50,193 @@ class sensebuffer(Structure):
         ('additional_sense_qualifier', c_ubyte),
         ('_reserved0', 3*c_ubyte),
         ('additional_sense_length', c_ubyte),
-        # ... sense data descriptors
+        # ... sense data descriptors, or the rest of fixed format sense
+        ('_rest', 10*c_ubyte),
     ]
+    def decode(self):
+        "(sense key, additional sense code, qualifier) from fixed or descriptor format"
+        raw = bytes(self)
+        if self.response_code & 0x7f in (0x72, 0x73):
+            return raw[1]&0xf, raw[2], raw[3]
+        return raw[2]&0xf, raw[12], raw[13]
     def __str__(self):
-        return str({a: getattr(self, a) for a in dir(self) if not a.startswith('_')})
+        return "sense key %#x, asc %#x, ascq %#x"%self.decode()
+
+# SCSI status
+GOOD, CHECK_CONDITION, BUSY = 0, 2, 8
+# Sense keys
+NO_SENSE, RECOVERED_ERROR, NOT_READY, UNIT_ATTENTION, ABORTED_COMMAND = 0, 1, 2, 6, 0xb
+# driver_status when sense data was written
+DRIVER_SENSE = 0x08
+
+class ScsiError(IOError):
+    "Command failed, or kept failing"
+
+class Backoff:
+    "Retry delay that doubles while the device stays busy and halves as commands succeed"
+    def __init__(self, least=0.001, most=0.5):
+        self.least = self.delay = least
+        self.most = most
+    def success(self):
+        self.delay = max(self.least, self.delay/2)
+    def failure(self):
+        "Delay before the next try"
+        self.delay = min(self.most, self.delay*2)
+        return self.delay
 
 class ScsiTarget(lytro.Target):
-    def __init__(self, name):
+    # Tries per command before giving up
+    tries = 10
+    def __init__(self, name, window=1):
+        """window>1 queues that many download commands to the kernel at once,
+        using the asynchronous write()/read() interface of the sg device"""
         if not name.startswith('sg:'):
             raise ValueError(f"Not a SG target: {name}")
         self.fd = posix.open(name[3:], posix.O_RDWR)
+        self.window = window
+        self.backoff = Backoff()
+        self.packids = itertools.count(1)
+    # Lytro can produce 32KiB per transfer (SG allows 64)
+    maxtransfer = 1<<15
+    # Candidates for tuning.TunedTarget
+    transfersizes = (1<<15, 1<<16)
+    def header(self, command, sb, direction, dxferp, size, pack_id=0):
+        return sg_io_hdr(interface_id=ord('S'), timeout=1000,
+                         cmdp=command, cmd_len=len(command),
+                         mx_sb_len=sizeof(sb), sbp=cast(pointer(sb), POINTER(c_ubyte)),
+                         dxfer_direction=direction,
+                         dxferp=dxferp, dxfer_len=size, pack_id=pack_id)
+    @staticmethod
+    def check(hdr, sb):
+        "True if the command completed, False if it's worth another try; raises otherwise"
+        if hdr.host_status or hdr.driver_status & ~DRIVER_SENSE & 0xf:
+            # Transport trouble, e.g. the camera restarting
+            return False
+        if hdr.status == BUSY:
+            return False
+        if hdr.status == CHECK_CONDITION or hdr.sb_len_wr:
+            key = sb.decode()[0]
+            if key in (NO_SENSE, RECOVERED_ERROR):
+                return True
+            if key in (NOT_READY, UNIT_ATTENTION, ABORTED_COMMAND):
+                return False
+            raise ScsiError(f"Command failed: {sb}")
+        if hdr.status != GOOD:
+            raise ScsiError(f"Command failed: status {hdr.status:#x}")
+        return True
     def read(self, command, size):
-        # Lytro can produce 32KiB per transfer (SG allows 64)
-        sizelimit = 1<<15
-        if size > sizelimit:
-            size = sizelimit
-        buf = create_string_buffer(size)
-        for n in range(10):
+        buf = bytearray(min(size, self.maxtransfer))
+        return buf[:self.readinto(command, buf)]
+    def readinto(self, command, buf):
+        size = min(len(buf), self.maxtransfer)
+        # Let the kernel write straight into the caller's buffer
+        dest = (c_char*size).from_buffer(buf)
+        for n in range(self.tries):
             sb = sensebuffer()
-            hdr = sg_io_hdr(interface_id=ord('S'), timeout=1000,
-                            cmdp=command, cmd_len=len(command),
-                            mx_sb_len=sizeof(sb), sbp=cast(pointer(sb), POINTER(c_ubyte)),
-                            dxfer_direction=SG_DXFER_FROM_DEV,
-                            dxferp=cast(pointer(buf), c_void_p), dxfer_len=size)
+            hdr = self.header(command, sb, SG_DXFER_FROM_DEV, addressof(dest), size)
             result = fcntl.ioctl(self.fd, SG_IO, hdr)
             assert result==0
-            if sb.response_code==0:
-                break
-            time.sleep(0.05)
-        # FIXME: nothing is read? our buffer seems to hold only nul
-        # It works fine for the time, battery and size commands
-        #print(sb)
-        #print(repr(buf.raw[:16]))
-        return buf.raw[:size-hdr.resid]
+            if self.check(hdr, sb):
+                self.backoff.success()
+                return size-hdr.resid
+            self.retried('sense')
+            time.sleep(self.backoff.failure())
+        # Downloads used to come back as nul here, as if they had worked;
+        # a sense response is now a retry, and an error once they run out
+        raise ScsiError(f"No response after {self.tries} tries: {sb}")
+    def submit(self, pending, request, tries):
+        "Queue a read to the kernel without waiting for it"
+        command, buf = request[0], request[1]
+        size = min(len(buf), self.maxtransfer)
+        sb = sensebuffer()
+        dest = (c_char*size).from_buffer(buf)
+        packid = next(self.packids)
+        posix.write(self.fd, self.header(command, sb, SG_DXFER_FROM_DEV, addressof(dest), size, packid))
+        # The kernel fills dest and sb when it completes; keep them alive until then
+        pending[packid] = request, size, sb, dest, tries
+    def complete(self, pending):
+        "Wait for the next queued command. Returns its header and pending entry."
+        hdr = sg_io_hdr.from_buffer_copy(posix.read(self.fd, sizeof(sg_io_hdr)))
+        return hdr, pending.pop(hdr.pack_id)
+    def readmany(self, requests):
+        "Keep up to window commands queued to the kernel, yielding (request, received) as they complete"
+        if self.window <= 1:
+            yield from super().readmany(requests)
+            return
+        requests = iter(requests)
+        pending = {}
+        # (when, request, tries) waiting out a backoff
+        retries = []
+        poller = select.poll()
+        poller.register(self.fd, select.POLLIN)
+        try:
+            while True:
+                now = time.monotonic()
+                while retries and retries[0][0] <= now and len(pending) < self.window:
+                    when, request, tries = retries.pop(0)
+                    self.submit(pending, request, tries)
+                while len(pending) + len(retries) < self.window:
+                    request = next(requests, None)
+                    if request is None:
+                        break
+                    self.submit(pending, request, 0)
+                if not pending:
+                    if not retries:
+                        return
+                    time.sleep(max(0, retries[0][0]-now))
+                    continue
+                if retries and not poller.poll(max(0, (retries[0][0]-now)*1000)):
+                    continue
+                hdr, (request, size, sb, dest, tries) = self.complete(pending)
+                if self.check(hdr, sb):
+                    self.backoff.success()
+                    yield request, size-hdr.resid
+                elif tries+1 < self.tries:
+                    self.retried('sense')
+                    retries.append((time.monotonic()+self.backoff.failure(), request, tries+1))
+                    retries.sort(key=lambda retry: retry[0])
+                else:
+                    raise ScsiError(f"No response after {self.tries} tries: {sb}")
+        finally:
+            # Don't let the kernel write into buffers we no longer own
+            while pending:
+                self.complete(pending)
     def write(self, command, data):
         data = create_string_buffer(data)
-        sb = sensebuffer()
-        hdr = sg_io_hdr(interface_id=ord('S'), timeout=1000,
-                        cmdp=command, cmd_len=len(command),
-                        mx_sb_len=0, #sbp=cast(pointer(sb), POINTER(c_ubyte)),
-                        dxfer_direction=SG_DXFER_TO_DEV,
-                        dxferp=cast(pointer(data), c_void_p), dxfer_len=len(data))
-        fcntl.ioctl(self.fd, SG_IO, hdr)
+        for n in range(self.tries):
+            sb = sensebuffer()
+            hdr = self.header(command, sb, SG_DXFER_TO_DEV, cast(pointer(data), c_void_p), len(data))
+            fcntl.ioctl(self.fd, SG_IO, hdr)
+            if self.check(hdr, sb):
+                self.backoff.success()
+                return
+            self.retried('sense')
+            time.sleep(self.backoff.failure())
+        raise ScsiError(f"No response after {self.tries} tries: {sb}")
+
+def devicepath(name):
+    return name
+
+def opendevice(path):
+    "ScsiTarget for a path from probe, checking it's still a Lytro"
+    if not path.startswith('sg:'):
+        raise ValueError(f"Not a SG target: {path}")
+    with open(f"/sys/class/scsi_generic/{path.rsplit('/', 1)[-1]}/device/vendor") as f:
+        if f.read() != 'Lytro   \n':
+            raise IOError(f"Not a Lytro: {path}")
+    return ScsiTarget(path)
+
+def usbpath(path):
+    "USB bus:address of the camera behind an SG path, or None"
+    import os
+    device = os.path.realpath(f"/sys/class/scsi_generic/{path.rsplit('/', 1)[-1]}/device")
+    while device != '/':
+        try:
+            with open(os.path.join(device, 'busnum')) as bus, open(os.path.join(device, 'devnum')) as address:
+                return f"{int(bus.read())}:{int(address.read())}"
+        except (OSError, ValueError):
+            device = os.path.dirname(device)
+    return None
 
 def probe():
     import pathlib
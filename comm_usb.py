@@ -3,6 +3,8 @@
 # Talks to Lytro via USB mass storage bulk protocol
 # Using PyUSB
 
+import array
+import errno
 import struct
 import usb.core
 import lytro
@@ -12,8 +14,23 @@ import lytro
 # It has two configurations for unknown reasons.
 # It presents a CD-ROM with a link to the (dead) site.
 # The protocol is listed as 80, which is 50h=mass storage class bulk-only (BBB).
+# Each command is a CBW out, an optional data phase and a CSW in; see the
+# USB Mass Storage Class Bulk-Only Transport spec for the recovery steps.
+
+cbw = struct.Struct('<4sIIBBB16s')
+csw = struct.Struct('<4sIIB')
+
+class CommandError(IOError):
+    "Command failed, or its status didn't make sense"
 
 class UsbTarget(lytro.Target):
+    # No cap by default; the whole remainder is requested in one command
+    maxtransfer = None
+    # Candidates for tuning.TunedTarget
+    transfersizes = (1<<15, 1<<16, 1<<17, 1<<18)
+    # Largest bulk read; bounds the array PyUSB reads into (a multiple of
+    # the packet size, so only the device's end of data is a short read)
+    chunksize = 1<<20
     def __init__(self, dev):
         self.handle = dev
         # TODO: parse configuration for endpoints?
@@ -27,9 +44,19 @@ class UsbTarget(lytro.Target):
         self.epin = 0x82
         #for ep in self.epin, self.epout:
         #    self.handle.resetEndpoint(ep)
+        self.interface = 0
         self.tag=0
-        # Try to read out leftovers? Reset device?
-        self.flushIn()
+        self.inbuf = array.array('B')
+        # Start from a known state, whatever a previous session left behind
+        try:
+            self.reset()
+        except usb.core.USBError:
+            self.flushIn()
+    def reset(self):
+        "Bulk-Only Mass Storage Reset, then clear both endpoints (reset recovery)"
+        self.handle.ctrl_transfer(0x21, 0xff, 0, self.interface, None, 1000)
+        self.handle.clear_halt(self.epin)
+        self.handle.clear_halt(self.epout)
     def flushIn(self):
         data = True
         while data:
@@ -41,28 +68,99 @@ class UsbTarget(lytro.Target):
     def newTag(self):
         self.tag+=1
         return self.tag
+    def inbuffer(self, size):
+        "Reusable array for PyUSB to read into; it won't take memoryviews"
+        if len(self.inbuf) != size:
+            self.inbuf = array.array('B', bytes(size))
+        return self.inbuf
     def read(self, command, size):
+        buf = bytearray(size if self.maxtransfer is None else min(size, self.maxtransfer))
+        return buf[:self.readinto(command, buf)]
+    def command(self, command, size, direction):
+        "Send a CBW. Returns its tag."
+        tag = self.newTag()
         self.handle.write(self.epout,
-                              struct.pack('<4sIIBBB16s', b'USBC', self.newTag(),
-                                          size, 0x80, 0, len(command), command),
-                              100)
-        data = b''
-        while len(data)<size:
-            data += self.handle.read(self.epin, size-len(data), 1000)
-        # FIXME: Second call here gets a Pipe error during download?
-        #print "Got data: ", repr(data)
-        csw=self.handle.read(self.epin, 13, 100)   # TODO: Error handling. Not that Lytro did any...
-        return bytearray(data)
+                          cbw.pack(b'USBC', tag, size, direction, 0, len(command), command),
+                          100)
+        return tag
+    def datain(self, view):
+        """Data phase: bulk reads of up to chunksize each, into a reusable
+        array, copied on into view. libusb submits each as a queue of URBs, so
+        the link doesn't idle between packets, and memory stays bounded
+        however large the transfer. Returns the byte count, which is short if
+        the device ended early."""
+        size = len(view)
+        received = 0
+        while received < size:
+            n = min(size-received, self.chunksize)
+            if n == self.chunksize or size <= self.chunksize:
+                inbuf = self.inbuffer(n)
+            else:
+                # The tail of a long transfer; keep the reused array full size
+                inbuf = array.array('B', bytes(n))
+            try:
+                # Allow for USB 1.1 speeds on top of the usual timeout
+                got = self.handle.read(self.epin, inbuf, 1000 + n//1000)
+            except usb.core.USBError as e:
+                if e.errno != errno.EPIPE:
+                    raise
+                # Stalled data phase; the status follows once the halt is cleared
+                self.retried('stall')
+                self.handle.clear_halt(self.epin)
+                return received
+            view[received:received+got] = memoryview(inbuf)[:got]
+            received += got
+            if got < n:
+                break
+        return received
+    def status(self, tag):
+        "Read and check the CSW for tag. Returns the data residue."
+        try:
+            data = self.handle.read(self.epin, csw.size, 1000)
+        except usb.core.USBError as e:
+            if e.errno != errno.EPIPE:
+                raise
+            # A stalled status read is retried once after clearing the halt
+            self.retried('stall')
+            self.handle.clear_halt(self.epin)
+            data = self.handle.read(self.epin, csw.size, 1000)
+        if len(data) != csw.size:
+            self.reset()
+            raise CommandError(f"Bad status length {len(data)}")
+        signature, statustag, residue, status = csw.unpack(data)
+        if signature != b'USBS' or statustag != tag:
+            self.reset()
+            raise CommandError(f"Bad status {bytes(data)!r} for tag {tag}")
+        if status == 2:
+            # Phase error: the device lost track of the command
+            self.retried('reset')
+            self.reset()
+            raise CommandError(f"Phase error, tag {tag}")
+        if status:
+            raise CommandError(f"Command failed, tag {tag}")
+        return residue
+    def readinto(self, command, buf):
+        size = len(buf) if self.maxtransfer is None else min(len(buf), self.maxtransfer)
+        tag = self.command(command, size, 0x80)
+        received = self.datain(memoryview(buf)[:size]) if size else 0
+        residue = self.status(tag)
+        return min(received, size-residue)
     def write(self, command, data):
-        self.handle.write(self.epout,
-                              struct.pack('<4sIIBBB16s', b'USBC', self.newTag(),
-                                          len(data), 0, 0, len(command), command),
-                              100)
+        tag = self.command(command, len(data), 0)
         if data:
             self.handle.write(self.epout, data, 100)
-        # Read status packet (TODO: handle it!)
-        csw=self.handle.read(self.epin, 13, 100)
-        
+        self.status(tag)
+
+def devicepath(dev):
+    return f"{dev.bus}:{dev.address}"
+
+def opendevice(path):
+    "UsbTarget for the Lytro at bus:address"
+    bus, address = (int(n) for n in path.split(':'))
+    dev = usb.core.find(idVendor=0x24cf, idProduct=0x00a1, bus=bus, address=address)
+    if dev is None:
+        raise IOError(f"No Lytro at USB {path}")
+    return UsbTarget(dev)
 
 def probe():
     # This produces the device connection.
@@ -0,0 +1,185 @@
+#! /usr/bin/env python3
+# Batch conversion of RAW sensor data files to images.
+# Each file is converted by a worker process, from read through encode, and
+# up to twice as many files as there are workers are queued at once, so one
+# file's reading overlaps another's decoding and a third's encoding, while
+# memory stays bounded. Files are independent, so throughput scales with
+# cores until the disk can't keep up.
+# Outputs newer than their RAW and TXT files are skipped. Metadata comes
+# from the TXT file next to each RAW, as in rawview.py; a RAW without one
+# is reported and skipped.
+
+import collections
+import concurrent.futures
+import os
+import time
+
+import numpy as np
+from PIL import Image
+
+import demosaic
+import rawview
+
+formats = {'png': 'PNG', 'jpg': 'JPEG', 'tiff': 'TIFF', 'npy': None}
+methods = ('subsampled',) + tuple(demosaic.methods)
+
+def metadatafile(name):
+    "The TXT file next to RAW file name, in whatever case (the picture store's are lower case), or None"
+    base, ext = name.rsplit('.', 1)
+    # Same case as the RAW first, then any
+    for suffix in ('.txt', '.TXT') if ext.islower() else ('.TXT', '.txt'):
+        if os.path.exists(base+suffix):
+            return base+suffix
+    directory, stem = os.path.split(base)
+    try:
+        for file in sorted(os.listdir(directory or '.')):
+            if file.lower() == stem.lower()+'.txt':
+                return os.path.join(directory, file)
+    except OSError:
+        pass
+    return None
+
+def outputname(name, root, outdir, format):
+    "Output path for RAW file name, mirroring its place under root"
+    relative = os.path.relpath(name, root) if root else os.path.basename(name)
+    return os.path.join(outdir, relative.rsplit('.', 1)[0]+'.'+format)
+
+def uptodate(name, output):
+    try:
+        made = os.stat(output).st_mtime
+    except OSError:
+        return False
+    sources = [name] + [path for path in (metadatafile(name),) if path is not None]
+    return all(os.stat(source).st_mtime <= made for source in sources)
+
+def linear(mosaic, metadata):
+    "(h/2,w/2,3) uint16 sensor levels, one per 2x2 mosaic tile, green averaged"
+    sites = metadata.sites()
+    def plane(c):
+        return mosaic[sites[c][0]::2, sites[c][1]::2]
+    out = np.empty(plane('r').shape+(3,), np.uint16)
+    out[...,0] = plane('r')
+    np.add(plane('gr'), plane('gb'), out=out[...,1])
+    out[...,1] >>= 1
+    out[...,2] = plane('b')
+    return out
+
+def convert(name, output, format='png', method='subsampled'):
+    "Convert one RAW file. Returns seconds spent per stage."
+    times = collections.OrderedDict()
+    start = time.perf_counter()
+    def stage(label):
+        nonlocal start
+        now = time.perf_counter()
+        times[label] = times.get(label, 0.0) + now-start
+        start = now
+    txt = metadatafile(name)
+    if txt is None:
+        # Defaults would give the wrong colour and white balance without a word
+        raise FileNotFoundError(f"No TXT metadata next to {name}")
+    metadata = rawview.RawMetadata.load(txt)
+    with open(name, 'rb') as f:
+        data = f.read()
+    stage('read')
+    w, h = metadata.width, metadata.height
+    if method == 'subsampled' and format != 'npy':
+        # Unpacking and colour are fused per tile of rows
+        image = rawview.load_raw(data, metadata=metadata)
+        stage('convert')
+    else:
+        mosaic = rawview.load_mosaic(data, w, h)
+        stage('decode')
+        if method == 'subsampled':
+            out = linear(mosaic, metadata)
+        else:
+            if metadata.sites() != {'b': demosaic.B, 'gb': demosaic.G0, 'gr': demosaic.G1, 'r': demosaic.R}:
+                raise ValueError(f"Unsupported mosaic: {metadata.tile} from {metadata.upperleft}")
+            a = demosaic.methods[method](mosaic)
+            stage('demosaic')
+            if format == 'npy':
+                out = np.rint(np.clip(a, 0, 4095, out=a)).astype(np.uint16)
+            else:
+                out = np.empty(a.shape, np.uint8)
+                for y in range(0, h, 256):
+                    rawview.colour(a[y:y+256], metadata, out[y:y+256])
+                image = Image.frombytes('RGB', (w, h), out)
+        stage('colour')
+    os.makedirs(os.path.dirname(output) or '.', exist_ok=True)
+    # Write beside the output and rename, so an interrupted run leaves no
+    # truncated file that looks up to date
+    temporary = output+'.tmp'
+    if format == 'npy':
+        with open(temporary, 'wb') as f:
+            np.save(f, out)
+    else:
+        image.save(temporary, formats[format])
+    os.replace(temporary, output)
+    stage('encode')
+    return times
+
+def findraw(paths):
+    "(root, RAW file) for each file given or found under each directory given"
+    for path in paths:
+        if os.path.isdir(path):
+            for directory, subdirs, files in os.walk(path):
+                subdirs.sort()
+                for file in sorted(files):
+                    if file.upper().endswith('.RAW'):
+                        yield path, os.path.join(directory, file)
+        else:
+            yield None, path
+
+def batch(paths, outdir, format='png', method='subsampled', workers=None, force=False, verbose=True):
+    "Convert all RAW files in paths. Returns (converted, skipped, seconds per stage, wall seconds)."
+    workers = workers or os.cpu_count() or 1
+    jobs = ((name, outputname(name, root, outdir, format)) for root, name in findraw(paths))
+    totals = collections.Counter()
+    converted = skipped = 0
+    started = time.perf_counter()
+    with concurrent.futures.ProcessPoolExecutor(workers) as pool:
+        pending = {}
+        def fill():
+            nonlocal skipped
+            # Bounded, so a huge archive isn't all queued at once
+            while len(pending) < 2*workers:
+                job = next(jobs, None)
+                if job is None:
+                    return
+                name, output = job
+                if not force and uptodate(name, output):
+                    skipped += 1
+                    continue
+                pending[pool.submit(convert, name, output, format, method)] = name
+        fill()
+        while pending:
+            done, _ = concurrent.futures.wait(pending, return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in done:
+                name = pending.pop(future)
+                try:
+                    totals.update(future.result())
+                    converted += 1
+                    if verbose: print(f"{name}")
+                except (OSError, ValueError) as e:
+                    print(f"{name}: {e}")
+            fill()
+    return converted, skipped, dict(totals), time.perf_counter()-started
+
+if __name__=='__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description='Convert Lytro RAW files to images in parallel.')
+    parser.add_argument('paths', nargs='+', help='RAW files, or directories to search for them')
+    parser.add_argument('--output', '-o', default='.', help='Output directory')
+    parser.add_argument('--format', '-f', choices=formats, default='png',
+                        help='Output format; npy is 16 bit sensor levels')
+    parser.add_argument('--method', choices=methods, default='subsampled',
+                        help='subsampled is half resolution; the others demosaic to full resolution')
+    parser.add_argument('--workers', '-j', type=int, help='Worker processes (default: one per core)')
+    parser.add_argument('--force', action='store_true', help='Convert even if the output is up to date')
+    parser.add_argument('--quiet', '-q', action='store_true')
+    args = parser.parse_args()
+    converted, skipped, totals, elapsed = batch(args.paths, args.output, args.format, args.method,
+                                                args.workers, args.force, not args.quiet)
+    print(f"Converted {converted}, skipped {skipped} up to date, in {elapsed:.2f}s"
+          + (f" ({converted/elapsed:.2f} files/s)" if converted else ''))
+    for label, seconds in totals.items():
+        print(f"  {label:9} {seconds:8.2f}s total, {seconds/max(converted, 1)*1e3:8.1f} ms/file")
@@ -0,0 +1,215 @@
+#! /usr/bin/env python3
+# Local Lytro F01 emulator speaking the TCP protocol of comm_ip.py, so
+# transports and downloads can be measured without a camera.
+# Each connection has a reader, which answers commands as they arrive, and a
+# writer, which sends the replies once the link latency has passed and at
+# most at the link bandwidth. So pipelined commands overlap their latency
+# like they would on a network, while the camera itself stays serial.
+# Faults are injected into download replies: short, empty, or a dropped
+# connection.
+
+import json
+import queue
+import random
+import socket
+import socketserver
+import struct
+import threading
+import time
+
+import lytro
+
+magic = 0xfaaa55af
+header = struct.Struct('<3I16s')
+
+class Camera:
+    "Synthetic camera contents and state, shared by all connections"
+    def __init__(self, pictures=3, rawsize=3280*3280*3//2, seed=0):
+        rng = random.Random(seed)
+        self.lock = threading.Lock()
+        self.files = {}
+        self.loaded = b''
+        self.battery = 87.5
+        self.time = (2012, 3, 4, 5, 6, 7, 0)
+        self.files[lytro.loadtypes['hardware_info'], None] = struct.pack(
+            '256s128s128s128s4s', b'Lytro, Inc.', b'EMU0000001', b'emulator', b'1.0', b'')
+        self.files[lytro.loadtypes['calibration'], None] = rng.randbytes(1<<20)
+        # One block of sensor noise shared by every RAW; only the lengths differ
+        raw = rng.randbytes(rawsize)
+        records = []
+        self.ids = []
+        for i in range(pictures):
+            id = f"sha1-{rng.getrandbits(160):040x}"
+            self.ids.append(id)
+            records.append(struct.pack(lytro.PictureRecord.structstring, b'LYTRO', b'IMG_', 100, i+1,
+                                       i%2, 1.0, id.encode('ascii'), f"2012-03-04T05:{i%60:02}:07.000Z".encode('ascii'), 1))
+            txt = json.dumps({'image': {'width': 3280, 'height': 3280,
+                                        'pixelPacking': {'bitsPerPixel': 12, 'endianness': 'big'}},
+                              'picture': {'id': id}}).encode('ascii')
+            blobs = {'jpg': rng.randbytes(1<<16), 'raw': raw, 'txt': txt, '128': rng.randbytes(128*128*2)}
+            for subtype, blob in blobs.items():
+                self.files[lytro.loadtypes['picture'], id+chr(lytro.picturesubtypes.index(subtype))] = blob
+                path = rf"I:\DCIM\100LYTRO\IMG_{i+1:04}.{subtype.upper()}"
+                self.files[lytro.loadtypes['file'], path] = blob
+        recordlist = b''.join(records)
+        self.files[lytro.loadtypes['picture_list'], None] = struct.pack('<3I', 1, len(recordlist), 0) + recordlist
+    def load(self, sort, name=None):
+        with self.lock:
+            self.loaded = self.files.get((sort, name), b'')
+    def read(self, command, size):
+        "Reply payload to a read command; views of the loaded file aren't copied"
+        if command[0] == lytro.LytroLoad.command:
+            self.load(command[2])
+            return b''
+        if command[0] == lytro.LytroQuery.command:
+            query = command[2]
+            if query == lytro.LytroQuerySize.query:
+                return struct.pack('<I', len(self.loaded))
+            if query == lytro.LytroQueryBattery.query:
+                return struct.pack('<f', self.battery)
+            if query == lytro.LytroQueryTime.query:
+                return struct.pack('<7H', *self.time)
+            return b''
+        if command[0] == lytro.LytroDownload.command:
+            offset, = struct.unpack_from('<I', command, 3)
+            return memoryview(self.loaded)[offset:offset+size]
+        return b''
+    def write(self, command, data):
+        if command[0] == lytro.LytroLoad.command:
+            # Only drop the terminator: the jpg subtype byte is a NUL too
+            self.load(command[2], bytes(data[:-1]).decode('ascii') if data else None)
+        elif command[0] == lytro.LytroSetTime.command:
+            self.time = struct.unpack('<7H', bytes(data[:14]))
+
+class Link:
+    "Latency, bandwidth and faults of the emulated connection"
+    def __init__(self, latency=0.0, bandwidth=None, short=0.0, empty=0.0, disconnect=0.0, seed=0):
+        "latency in seconds, bandwidth in bytes/second; faults are probabilities per download reply"
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.short = short
+        self.empty = empty
+        self.disconnect = disconnect
+        self.random = random.Random(seed)
+    def fault(self, payload):
+        "Payload as it reaches the client, or None to drop the connection"
+        r = self.random.random()
+        if r < self.disconnect:
+            return None
+        r -= self.disconnect
+        if r < self.empty:
+            return payload[:0]
+        r -= self.empty
+        if r < self.short and len(payload) > 1:
+            return payload[:len(payload)//2]
+        return payload
+
+class Handler(socketserver.BaseRequestHandler):
+    def handle(self):
+        camera, link = self.server.camera, self.server.link
+        self.request.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        replies = queue.Queue()
+        writer = threading.Thread(target=self.write, args=(replies, link), daemon=True)
+        writer.start()
+        try:
+            while True:
+                data = self.recv(header.size)
+                if data is None:
+                    break
+                m, size, seq, command = header.unpack(data)
+                if m != magic:
+                    break
+                if seq == 0:
+                    # Write; the reply mirrors the data
+                    payload = self.recv(size) if size else b''
+                    if payload is None:
+                        break
+                    camera.write(command, payload)
+                    reply = payload
+                    seq = 2
+                else:
+                    reply = camera.read(command, size)
+                    if command[0] == lytro.LytroDownload.command:
+                        reply = link.fault(reply)
+                        if reply is None:
+                            break
+                    seq = 3
+                replies.put((time.perf_counter()+link.latency, header.pack(magic, len(reply), seq, command), reply))
+        finally:
+            replies.put(None)
+            writer.join()
+    def recv(self, size):
+        buf = bytearray(size)
+        view = memoryview(buf)
+        received = 0
+        while received < size:
+            try:
+                n = self.request.recv_into(view[received:])
+            except ConnectionError:
+                # Clients reset connections they've given up on
+                return None
+            if not n:
+                return None
+            received += n
+        return buf
+    def write(self, replies, link):
+        busy = time.perf_counter()
+        while True:
+            reply = replies.get()
+            if reply is None:
+                break
+            due, head, payload = reply
+            now = time.perf_counter()
+            if due > now:
+                time.sleep(due-now)
+            try:
+                self.request.sendall(head)
+                self.request.sendall(payload)
+            except OSError:
+                break
+            if link.bandwidth:
+                # Hold the link for as long as the reply takes to go through
+                busy = max(busy, due) + (len(head)+len(payload))/link.bandwidth
+                now = time.perf_counter()
+                if busy > now:
+                    time.sleep(busy-now)
+        self.request.close()
+
+class Emulator(socketserver.ThreadingTCPServer):
+    "Serves a Camera over TCP; use address with comm_ip.IpTarget"
+    daemon_threads = True
+    allow_reuse_address = True
+    def __init__(self, camera=None, link=None, address=('127.0.0.1', 0)):
+        super().__init__(address, Handler)
+        self.camera = Camera() if camera is None else camera
+        self.link = Link() if link is None else link
+        self.address = self.server_address
+    def start(self):
+        "Serve from a background thread. Returns the address."
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+        return self.address
+    def __enter__(self):
+        self.start()
+        return self
+    def __exit__(self, *exc):
+        self.shutdown()
+        self.server_close()
+
+if __name__=='__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description='Emulate a Lytro F01 camera over TCP.')
+    parser.add_argument('--address', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=5678)
+    parser.add_argument('--pictures', type=int, default=3)
+    parser.add_argument('--latency', type=float, default=0.0, help='Link latency in ms')
+    parser.add_argument('--bandwidth', type=float, help='Link bandwidth in MB/s')
+    parser.add_argument('--short', type=float, default=0.0, help='Probability of a short download reply')
+    parser.add_argument('--empty', type=float, default=0.0, help='Probability of an empty download reply')
+    parser.add_argument('--disconnect', type=float, default=0.0, help='Probability of dropping the connection')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+    link = Link(args.latency/1e3, args.bandwidth and args.bandwidth*1e6,
+                args.short, args.empty, args.disconnect, args.seed)
+    server = Emulator(Camera(args.pictures, seed=args.seed), link, (args.address, args.port))
+    print(f"Emulating a Lytro F01 at {server.address[0]}:{server.address[1]}")
+    server.serve_forever()
@@ -0,0 +1,100 @@
+#! /usr/bin/env python3
+# Reader for the LFP container (e.g. raw.lfp, which holds the 128 thumbnail,
+# TXT metadata and RAW sensor data of a picture).
+# The file starts with a 16 byte header, followed by sections:
+#  8 byte magic (\x89LFM: table of contents, \x89LFC: content)
+#  4 byte version, 4 byte big endian data length
+#  80 byte sha1 reference, NUL padded
+#  data, padded to a multiple of 16 bytes
+# Only the section headers are read while indexing; the file is memory
+# mapped, so section data is paged in when a view of it is used.
+
+import json
+import mmap
+import struct
+from collections import namedtuple
+
+filemagic = b'\x89LFP\r\n\x1a\n'
+sectiontypes = {b'\x89LFM\r\n\x1a\n': 'LFM', b'\x89LFC\r\n\x1a\n': 'LFC'}
+header = struct.Struct('>8s4sI')
+refsize = 80
+
+Section = namedtuple('Section', ['type', 'offset', 'length', 'ref'])
+
+def scan(buf, offset=0):
+    "Index the sections of an LFP container in buf, yielding Sections"
+    view = memoryview(buf)
+    magic, version, length = header.unpack_from(view, offset)
+    if magic != filemagic:
+        raise ValueError(f"Not an LFP container: {bytes(magic)!r}")
+    offset += header.size + length
+    while offset + header.size + refsize <= len(view):
+        magic, version, length = header.unpack_from(view, offset)
+        if magic == filemagic:
+            # Concatenated containers, as in calibration data
+            offset += header.size + length
+            continue
+        if magic not in sectiontypes:
+            raise ValueError(f"Bad LFP section at {offset}: {bytes(magic)!r}")
+        offset += header.size
+        ref = bytes(view[offset:offset+refsize]).rstrip(b'\0').decode('ascii')
+        offset += refsize
+        yield Section(sectiontypes[magic], offset, length, ref)
+        offset += -(-length//16)*16
+
+class LfpFile:
+    def __init__(self, f):
+        "f is a file name or a file object opened for binary reading"
+        if isinstance(f, str):
+            with open(f, 'rb') as fo:
+                self.map = mmap.mmap(fo.fileno(), 0, access=mmap.ACCESS_READ)
+        else:
+            self.map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        self.sections = list(scan(self.map))
+        self.refs = {section.ref: section for section in self.sections}
+    def __enter__(self):
+        return self
+    def __exit__(self, *exc):
+        self.close()
+    def close(self):
+        "Views returned by section() must be released first"
+        self.map.close()
+    def view(self, section):
+        return memoryview(self.map)[section.offset:section.offset+section.length]
+    def section(self, ref):
+        "Zero-copy memoryview of the section with sha1 reference ref"
+        return self.view(self.refs[ref])
+    def toc(self):
+        "Parsed table of contents (the LFM section)"
+        for section in self.sections:
+            if section.type == 'LFM':
+                with self.view(section) as v:
+                    return json.loads(bytes(v))
+        return {}
+    def frame(self):
+        "References of the first picture frame: metadataRef, privateMetadataRef, imageRef"
+        frames = self.toc().get('picture', {}).get('frameArray', [])
+        return frames[0].get('frame', {}) if frames else {}
+    def metadata(self):
+        "TXT metadata, for rawview.RawMetadata"
+        return self.section(self.frame()['metadataRef'])
+    def image(self):
+        "RAW sensor data, for rawview.load_raw"
+        return self.section(self.frame()['imageRef'])
+    def thumbnail(self):
+        "128 thumbnail data, for tn128.decode_tn128"
+        for thumbnail in self.toc().get('thumbnails', self.toc().get('thumbnailArray', [])):
+            if thumbnail.get('imageRef') in self.refs:
+                return self.section(thumbnail['imageRef'])
+        # Not listed; recognise it by size (YUYV 128x128, maybe with a pad byte)
+        for section in self.sections:
+            if section.type == 'LFC' and section.length in (128*128*2, 128*128*2+1):
+                return self.view(section)
+        raise KeyError('No thumbnail section')
+
+if __name__=='__main__':
+    from sys import argv
+    for name in argv[1:]:
+        lfp = LfpFile(name)
+        for section in lfp.sections:
+            print(f"{name}: {section.type} {section.ref} at {section.offset}, {section.length} bytes")
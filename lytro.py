@@ -1,8 +1,17 @@
+import collections
 import datetime
-import dateutil.parser
+import importlib
+import itertools
+import json
+import os
+import queue
 import struct
+import threading
 import time
 
+# calibration, resume, concurrent.futures and the transports are imported
+# where they're used, so the command line starts quickly
+
 # Protocol references:
 #  http://optics.miloush.net/lytro/TheProtocols.Commands.aspx
 #  https://ljirkovsky.wordpress.com/2015/03/16/lytro-protocol/
@@ -11,9 +20,131 @@ from typing import Dict, Callable, Any
 
 # Abstract base class for communication modes
 class Target:
-    pass
+    # Download commands that may be in flight at once; 1 means no pipelining
+    window = 1
+    # Largest chunk per download command; None means no limit
+    maxtransfer = 1<<15
+    # Chunk sizes worth trying when tuning, see tuning.py
+    transfersizes = (1<<15,)
+    # stats.Stats counting retries, set by stats.StatsTarget
+    stats = None
+    def retried(self, kind):
+        if self.stats is not None:
+            self.stats.retry(kind)
+    def readinto(self, command, buf):
+        "Read the response to command into writable buffer buf. Returns number of bytes received."
+        # Fallback for transports without a zero-copy path
+        data = self.read(command, len(buf))
+        buf[:len(data)] = data
+        return len(data)
+    def readmany(self, requests):
+        """readinto for each (command, buf, ...) request, yielding (request, received).
+        A None request means nothing more to send for now: return once idle.
+        Transports that can pipeline override this to keep self.window in flight."""
+        for request in requests:
+            if request is None:
+                return
+            yield request, self.readinto(request[0], request[1])
 
-# TODO: Clean ups; separate query and response, perhaps add response queue per connection
+class Dispatcher(Target):
+    """Shares one Target between threads. Each command is queued with a tag
+    and a future; a worker thread feeds reads into the transport's readmany,
+    which matches replies to commands, and completes the futures.
+    Use it as the Target of a Lytro to poll battery or time during a download."""
+    def __init__(self, target):
+        self.target = target
+        self.window = target.window
+        self.queue = queue.Queue()
+        self.tags = itertools.count(1)
+        self.worker = threading.Thread(target=self.run, daemon=True)
+        self.worker.start()
+    def __getattr__(self, name):
+        return getattr(self.target, name)
+    # Target's class attributes would shadow __getattr__, so these forward explicitly
+    @property
+    def maxtransfer(self):
+        return self.target.maxtransfer
+    @property
+    def transfersizes(self):
+        return self.target.transfersizes
+    @property
+    def stats(self):
+        return self.target.stats
+    @stats.setter
+    def stats(self, stats):
+        self.target.stats = stats
+    def retried(self, kind):
+        self.target.retried(kind)
+    def submit(self, kind, *args):
+        "Queue a 'readinto' or 'write' for the worker. Returns (tag, future)."
+        import concurrent.futures
+        tag = next(self.tags)
+        future = concurrent.futures.Future()
+        self.queue.put((kind, args, tag, future))
+        return tag, future
+    def close(self):
+        self.queue.put(None)
+        self.worker.join()
+    def read(self, command, size):
+        buf = bytearray(size)
+        return buf[:self.readinto(command, buf)]
+    def readinto(self, command, buf):
+        return self.submit('readinto', command, buf)[1].result()
+    def write(self, command, data):
+        return self.submit('write', command, data)[1].result()
+    def readmany(self, requests):
+        # Keep up to window chunks queued, so they can share the transport's pipeline
+        queued = collections.deque()
+        for request in requests:
+            queued.append((request, self.submit('readinto', request[0], request[1])[1]))
+            if len(queued) >= self.window:
+                request, future = queued.popleft()
+                yield request, future.result()
+        for request, future in queued:
+            yield request, future.result()
+    def run(self):
+        job = self.queue.get()
+        while job is not None:
+            kind, args, tag, future = job
+            if kind == 'write':
+                try:
+                    future.set_result(self.target.write(*args))
+                except Exception as e:
+                    future.set_exception(e)
+                job = self.queue.get()
+                continue
+            # Feed this and any further queued reads into the transport's pipeline
+            following = []
+            def requests():
+                yield args[0], args[1], tag, future
+                while True:
+                    try:
+                        job = self.queue.get_nowait()
+                    except queue.Empty:
+                        yield None
+                        continue
+                    if job is None or job[0] == 'write':
+                        # Let the reads in flight drain first
+                        following.append(job)
+                        return
+                    yield job[1][0], job[1][1], job[2], job[3]
+            inflight = {}
+            try:
+                for request in self.target.readmany(self.track(requests(), inflight)):
+                    (command, buf, tag, future), received = request
+                    del inflight[tag]
+                    future.set_result(received)
+            except Exception as e:
+                for future in inflight.values():
+                    future.set_exception(e)
+            job = following[0] if following else self.queue.get()
+    @staticmethod
+    def track(requests, inflight):
+        "Note the futures of requests handed to the transport"
+        for request in requests:
+            if request is not None:
+                inflight[request[2]] = request[3]
+            yield request
 
 # Download IDs
 loadtypes = {
@@ -26,29 +157,43 @@ loadtypes = {
 }
 picturesubtypes = 'jpg,raw,txt,128,stk'.split(',')
 
+# Empty download replies in a row before a download is given up on
+maxempty = 5
+
 class LytroPacket(object):
     paramsstruct="15x"
     params=()
     length=0
     payload=b''
+    # Formats are compiled once per class, see __init_subclass__
+    codec=struct.Struct('<B15x')
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        if 'paramsstruct' in cls.__dict__:
+            cls.codec = struct.Struct('<B'+cls.paramsstruct)
+            assert cls.codec.size==16, f"Bad length: {cls.paramsstruct=}"
+        if 'payloadstruct' in cls.__dict__:
+            cls.payloadcodec = struct.Struct(cls.payloadstruct)
+    def pack(self):
+        return self.codec.pack(self.command, *self.params)
     def send(self, s):
-        assert struct.calcsize('<'+self.paramsstruct)==15, f"Bad length: {self.paramsstruct=}"
-        packet=struct.pack('<B'+self.paramsstruct, self.command, *self.params)
-        assert len(packet)==16, (struct.calcsize('<B'+self.paramsstruct), struct.calcsize('<'+self.paramsstruct), self.paramsstruct)
+        packet=self.pack()
         if self.payload:
             data=self.payload.ljust(self.length,b'\0')
             #print(f"Write command: {packet!r} {data!r}")
             s.write(packet, data)
         else:
             #print(f"Read command: {packet!r} {self.length}")
-            response=s.read(packet, self.length)
-            if self.length and response:
-                # Handle incoming data
-                return self.read(self.command, packet[1:], response)
+            return self.decode(packet, s.read(packet, self.length))
+        return None
+    def decode(self, packet, response):
+        "Parse the response to packet, as returned by a transport's read"
+        if self.length and response:
+            # Handle incoming data
+            return self.read(self.command, packet[1:], response)
         return None
     @classmethod
     def read(self, command, params, payload):
-        assert struct.calcsize('<'+self.paramsstruct)==15
         try:
             return LytroResponses[command](params,payload)
         except KeyError:
@@ -59,11 +204,14 @@ class LytroQuery(LytroPacket):
     command=0xc6
     paramsstruct="xB13x"
     def unpack(self):
-        return struct.unpack(self.payloadstruct, self.payload)
-    @classmethod
-    def response(self, params, payload):
-        (query,)=struct.unpack(self.paramsstruct, params)
-        return LytroQueries[query](payload)
+        return self.payloadcodec.unpack(self.payload)
+    def decode(self, packet, response):
+        # We know what we asked; no need to look it up
+        return type(self)(response) if response else None
+    @staticmethod
+    def response(params, payload):
+        # params[1] is the query type, per paramsstruct
+        return LytroQueries[params[1]](payload)
 
 class LytroQueryBattery(LytroQuery):
     payloadstruct = '<f'
@@ -103,7 +251,7 @@ class LytroSetTime(LytroPacket):
     # FIXME does not yet work. On the plus side, doesn't crash camera either.
     command = 0xc0
     params = (4,)
-    paramsstruct = ("xB13x",)
+    paramsstruct = "xB13x"
     def __init__(self, time):
         time = time.astimezone(datetime.timezone.utc)
         self.payload = struct.pack('<7H',
@@ -124,35 +272,52 @@ class LytroLoad(LytroPacket):
             self.payload=path.encode('ascii')+b'\0'
             self.length=len(path)+1  # NUL termination
 
+def loadpacket(loadtype, name=None, subtype=None):
+    "Build the LytroLoad selecting a file for download"
+    if loadtype=='picture' and subtype is not None:
+        name += chr(picturesubtypes.index(subtype))
+    return LytroLoad(loadtypes[loadtype], name)
+
 class LytroDownload(LytroPacket):
     # TODO: Figure out why this fails over SCSI transport. 
     command=0xc4
     paramsstruct="xBI9x"
     def __init__(self, length):
-        #print(f"{struct.calcsize('<'+self.paramsstruct)=}")
-        self.params=[1,0]
+        self.flag = 1
+        self.offset = 0
         self.data=b""
         self.length = length
     @property
-    def offset(self):
-        return self.params[1]
-    @offset.setter
-    def offset(self, offset):
-        self.params[1]=offset
+    def params(self):
+        return (self.flag, self.offset)
+    def pack(self):
+        # Called per chunk; skip building params
+        return self.codec.pack(self.command, self.flag, self.offset)
     def send(self,s):
-        LytroResponses[self.command]=self.receiveddata
         self.data = b""
         ret=super(LytroDownload,self).send(s)
         # Note: Increasing offset at send time is only helpful for pipelining.
         # If we do it in receiveddata, that provides a simple feedback for MTU. 
         #self.offset+=self.xferlength
         return ret
+    def readinto(self, s, buf):
+        "Download the chunk at the current offset straight into buf."
+        received = s.readinto(self.pack(), buf)
+        self.data = buf[:received]
+        self.offset += received
+        return received
+    def decode(self, packet, response):
+        # Our own handler rather than the shared LytroResponses table,
+        # so downloads on several connections don't step on each other
+        if response:
+            self.receiveddata(packet[1:], response)
+        return None
     def receiveddata(self, params, payload):
         #print(f"{params=}")
         self.data = payload
         self.offset += len(payload)
         #time.sleep(0.05)
-        #self.params[0]^=1
+        #self.flag^=1
         #print(f"Got {len(payload)} bytes: {payload!r}")
 
 # Hardware info
@@ -163,21 +328,41 @@ class HardwareInfo:
     def __str__(self):
         return str(self.__dict__)
 
+def isoparse(s):
+    "Parse an ISO 8601 timestamp; dateutil is only loaded if datetime can't"
+    try:
+        return datetime.datetime.fromisoformat(s)
+    except ValueError:
+        # Before Python 3.11, fromisoformat doesn't take the Z suffix
+        import dateutil.parser
+        return dateutil.parser.isoparse(s)
+
+def asciifield(index):
+    "Property decoding a NUL padded string field when it's used"
+    return property(lambda self: self.fields[index].rstrip(b'\0').decode('ascii'))
+
 class PictureRecord:
+    # A view of the unpacked fields; strings and datetime decode on access
+    __slots__ = ('fields', '_datetime')
     structstring = '<8s8sII4x4x4x4xIf48s28sI'
     size = struct.calcsize(structstring)
-    def __init__(self, b):
-        f = struct.unpack(self.structstring, b)
-        self.folderpostfix  = f[0].rstrip(b'\0').decode('ascii')
-        self.filenameprefix = f[1].rstrip(b'\0').decode('ascii')
-        self.folder         = f[2]
-        self.file           = f[3]
-        self.starred        = f[4]
-        self.focus          = f[5]
-        self.id             = f[6].rstrip(b'\0').decode('ascii')
-        self.datetime       = dateutil.parser.isoparse(f[7].rstrip(b'\0').decode('ascii'))
-        self.rotation       = {1:0, 8:90, 3:180, 6:270}[f[8]]
-        #print(self.__dict__)
+    rotations = {1:0, 8:90, 3:180, 6:270}
+    def __init__(self, b=None, fields=None):
+        self.fields = struct.unpack(self.structstring, b) if fields is None else fields
+        self._datetime = None
+    folderpostfix  = asciifield(0)
+    filenameprefix = asciifield(1)
+    folder         = property(lambda self: self.fields[2])
+    file           = property(lambda self: self.fields[3])
+    starred        = property(lambda self: self.fields[4])
+    focus          = property(lambda self: self.fields[5])
+    id             = asciifield(6)
+    rotation       = property(lambda self: self.rotations[self.fields[8]])
+    @property
+    def datetime(self):
+        if self._datetime is None:
+            self._datetime = isoparse(self.fields[7].rstrip(b'\0').decode('ascii'))
+        return self._datetime
     def pathname(self, extension="RAW"):
         "Return an internal filename in Lytro F01, usable with file download. Not needed since picture download works with id (hash)."
         # Basic problem: formatting is for strings, and we have a lot of bytes. Simple solution: decode and encode. 
@@ -188,97 +373,329 @@ class PictureList(list):
     downloadtype='picture_list'
     def __init__(self, b):
         super(PictureList,self).__init__()
+        b = memoryview(b)
         header = struct.unpack('<3I', b[:12])
         assert header[0] == 1
         itemsize = header[1]
         recordsperitem = header[2]
-        itemrecords = {
-            struct.unpack('<I', b[o:o+4])[0]: struct.unpack('<I', b[o+4:o+8])[0]
-            for o in range(12, 12+8*recordsperitem, 8)
-        }
+        itemrecords = dict(struct.iter_unpack('<2I', b[12:12+8*recordsperitem]))
         #print(itemrecords)
         # Need a better concept of what the item records mean.
-        self.extend(
-            #{index*0:
-            PictureRecord(b[base:base+PictureRecord.size])
-             #for (index,offset) in itemrecords.items()}
-            for base in range(12+8*recordsperitem, len(b), PictureRecord.size)
-        )
+        base = 12+8*recordsperitem
+        end = base + (len(b)-base)//PictureRecord.size*PictureRecord.size
+        # One pass over the buffer; records keep the unpacked tuples
+        self.extend(PictureRecord(fields=fields)
+                    for fields in struct.iter_unpack(PictureRecord.structstring, b[base:end]))
+    def filter(self, starred=None, folder=None, since=None, until=None):
+        """Records matching all given criteria, compared on the raw fields.
+        since and until are datetimes; the camera stores UTC ISO 8601 timestamps."""
+        def stamp(dt):
+            return dt.astimezone(datetime.timezone.utc).strftime('%Y-%m-%dT%H:%M:%S').encode('ascii')
+        since = since and stamp(since)
+        until = until and stamp(until)
+        return [record for record in self
+                if (starred is None or bool(record.fields[4]) == starred)
+                and (folder is None or record.fields[2] == folder)
+                and (since is None or record.fields[7][:19] >= since)
+                and (until is None or record.fields[7][:19] < until)]
 
 class Lytro:
-    def __init__(self, comm):
+    def __init__(self, comm, partialdir=None, cache=None):
         self.comm = comm
+        # Directory for resumable partial downloads, see resume.py
+        self.partialdir = partialdir
+        # Picture store consulted before downloading, see picturecache.py
+        self.cache = cache
+        # HardwareInfo.serial, once asked for; keys partial downloads
+        self.serial = None
+        # The loaded file is camera state: held from load until its transfer is done.
+        # Queries don't change it, so with a Dispatcher they can go in between.
+        # A shared target may lock the camera itself (broker.BrokerTarget).
+        self.lock = getattr(comm, 'session', None) or threading.RLock()
     def getbattery(self):
         return LytroQueryBattery().send(self.comm).percent()
     def gettime(self):
         return LytroQueryTime().send(self.comm).datetime()
     def settime(self, time=None):
         LytroSetTime(datetime.datetime.utcnow() if time is None else time.astimezone(datetime.timezone.utc))
-    def download(self, loadtype, name=None, subtype=None, verbose=True):
-        if loadtype=='picture' and subtype is not None:
-            name += chr(picturesubtypes.index(subtype))
-        load = LytroLoad(loadtypes[loadtype], name)
-        load.send(self.comm)
+    def retried(self, kind):
+        "Count a retry in the transport's stats, if it keeps any"
+        self.comm.retried(kind)
+    def load(self, loadtype, name=None, subtype=None):
+        "Select a file for download. Returns its size."
+        loadpacket(loadtype, name, subtype).send(self.comm)
         size = LytroQuerySize().send(self.comm).size()
         if size==0:
             raise FileNotFoundError(name)
+        return size
+    def transfer(self, size, buf, verbose=True, start=0):
+        """Receive the loaded file from offset start into buf, yielding (offset, memoryview)
+        for each chunk. If buf is smaller than size, it is reused for every chunk."""
+        started = time.perf_counter()
+        view = memoryview(buf)
+        if len(view) >= size and self.comm.window > 1:
+            yield from self.pipelined(size, view, verbose, start)
+        else:
+            yield from self.sequential(size, view, verbose, start)
+        # Wall time, since pipelined commands overlap
+        stats = getattr(self.comm, 'stats', None)
+        if stats is not None:
+            stats.transfer(time.perf_counter()-started, size-start)
+    def sequential(self, size, view, verbose=True, start=0):
+        "transfer one download command at a time"
+        inplace = len(view) >= size
         dl = LytroDownload(size)
-        received = 0
-        data = []
-        while received < size:
-            dl.offset = received
-            dl.send(self.comm)
-
-            if not dl.data:
+        dl.offset = start
+        empties = 0
+        while dl.offset < size:
+            offset = dl.offset
+            start = offset if inplace else 0
+            received = dl.readinto(self.comm, view[start:start+size-offset])
+            if not received:
+                self.retried('empty')
+                empties += 1
+                if empties >= maxempty:
+                    raise IOError(f"No data at offset {offset} after {empties} tries")
                 continue
-            assert len(dl.data)>0
-            data.append(dl.data)
-            received += len(dl.data)
-            #dl.params[0] ^= 1
+            empties = 0
+            #dl.flag ^= 1
             # FIXME: This may need delays for slow loading data!
             if verbose:
-                print(f"\rDownload: got {received}/{size} bytes", flush=True, end='')
+                print(f"\rDownload: got {dl.offset}/{size} bytes", flush=True, end='')
+            yield offset, view[start:start+received]
         if verbose:
             print()
-        # Future improvement: Download must check which block is actually returned,
-        # and could write in correct position using buffer memoryviews.
-        # PyUSB accepts memoryviews for read. SG accepts a pointer, so memoryview is OK.
-        # sockets have recv_into. 
-        return b''.join(data)[:size]
-    def gethardwareinfo(self):
-        data = self.download('hardware_info')
+    def pipelined(self, size, view, verbose=True, start=0):
+        """Receive into view with up to comm.window download commands in flight.
+        Chunks are placed by the offset they answer, so they may come out of order."""
+        step = self.comm.maxtransfer or Target.maxtransfer
+        def requests():
+            dl = LytroDownload(size)
+            for offset in range(start, size, step):
+                # Offset advances at send time; see LytroDownload.send
+                dl.offset = offset
+                yield dl.pack(), view[offset:offset+step], offset
+        received = start
+        gaps = []
+        for (command, buf, offset), n in self.comm.readmany(requests()):
+            if n < len(buf):
+                # Short or empty reply; fetch the rest once the pipeline drains
+                gaps.append((offset+n, offset+len(buf)))
+                self.retried('short')
+            if not n:
+                continue
+            received += n
+            if verbose:
+                print(f"\rDownload: got {received}/{size} bytes", flush=True, end='')
+            yield offset, view[offset:offset+n]
+        dl = LytroDownload(size)
+        for gapstart, gapend in gaps:
+            dl.offset = gapstart
+            empties = 0
+            while dl.offset < gapend:
+                offset = dl.offset
+                n = dl.readinto(self.comm, view[offset:gapend])
+                if not n:
+                    self.retried('empty')
+                    empties += 1
+                    if empties >= maxempty:
+                        raise IOError(f"No data at offset {offset} after {empties} tries")
+                    continue
+                empties = 0
+                received += n
+                yield offset, view[offset:offset+n]
+        if verbose:
+            print(f"\rDownload: got {received}/{size} bytes", flush=True)
+    def iterdownload(self, loadtype, name=None, subtype=None, verbose=True, chunksize=1<<15):
+        """Download a file chunk by chunk, holding no more than chunksize bytes.
+        Each yielded memoryview is only valid until the next one is received."""
+        with self.lock:
+            size = self.load(loadtype, name, subtype)
+            for offset, chunk in self.transfer(size, bytearray(min(size, chunksize)), verbose):
+                yield chunk
+    def download_to(self, f, loadtype, name=None, subtype=None, verbose=True):
+        "Download a file, writing chunks to file object f as they arrive. Returns size."
+        cached = self.cached(loadtype, name, subtype)
+        if cached is not None:
+            f.write(cached)
+            return len(cached)
+        size = 0
+        try:
+            for chunk in self.iterdownload(loadtype, name, subtype, verbose):
+                f.write(chunk)
+                size += len(chunk)
+        except FileNotFoundError:
+            self.uncached(loadtype, name, subtype)
+            raise
+        return size
+    def cacheable(self, loadtype, subtype):
+        return self.cache is not None and loadtype=='picture' and subtype is not None
+    def cached(self, loadtype, name, subtype):
+        """Look up a picture in the local store. Returns None on a miss, and
+        raises FileNotFoundError if the camera is known not to have it."""
+        if not self.cacheable(loadtype, subtype):
+            return None
+        return self.cache.get(name, subtype)
+    def uncached(self, loadtype, name, subtype):
+        "Note in the local store that the camera hasn't got a picture"
+        if self.cacheable(loadtype, subtype):
+            self.cache.missing(name, subtype)
+    def download(self, loadtype, name=None, subtype=None, verbose=True):
+        data = self.cached(loadtype, name, subtype)
+        if data is None:
+            try:
+                data = self.fetch(loadtype, name, subtype, verbose)
+            except FileNotFoundError:
+                self.uncached(loadtype, name, subtype)
+                raise
+            if self.cacheable(loadtype, subtype):
+                self.cache.put(name, subtype, data)
+        return data
+    def fetch(self, loadtype, name=None, subtype=None, verbose=True):
+        "Download a file from the camera, bypassing the picture store"
+        with self.lock:
+            return self.fetchlocked(loadtype, name, subtype, verbose)
+    def fetchlocked(self, loadtype, name, subtype, verbose):
+        # Only pictures are resumed: their ids name their content, while
+        # other files of the same name and size may differ
+        resumable = self.partialdir is not None and loadtype=='picture'
+        if resumable and self.serial is None:
+            # Before the load, as this is a download of its own
+            self.serial = self.gethardwareinfo(verbose=False).serial
+        size = self.load(loadtype, name, subtype)
+        # Preallocate the whole file; transports write each chunk in place
+        # (sockets recv_into, SG dxferp, PyUSB array), so there's no join.
+        data = bytearray(size)
+        if not resumable:
+            for offset, chunk in self.transfer(size, data, verbose):
+                pass
+            return data
+        # Keep what we receive on disk, so a crashed camera doesn't cost the whole file
+        import resume
+        with resume.PartialDownload(self.partialdir, self.serial, loadtype, name, subtype, size) as part:
+            start = part.readinto(data)
+            if verbose and start:
+                print(f"Resuming download at {start}/{size} bytes")
+            for offset, chunk in self.transfer(size, data, verbose, start):
+                part.write(offset, chunk)
+        part.remove()
+        return data
+    def gethardwareinfo(self, verbose=True):
+        data = self.download('hardware_info', verbose=verbose)
         return HardwareInfo(data)
-    def getpicturelist(self):
-        data = self.download('picture_list')
+    def getcalibration(self, store=None, verbose=True):
+        "Calibration data. With a calibration.CalibrationStore, each camera's is only downloaded once."
+        import calibration
+        if store is None:
+            return calibration.Calibration(self.download('calibration', verbose=verbose))
+        serial = self.gethardwareinfo(verbose=False).serial
+        cal = store.get(serial)
+        if cal is None:
+            cal = calibration.Calibration(self.download('calibration', verbose=verbose))
+            store.put(serial, cal)
+        return cal
+    def getpicturelist(self, verbose=True):
+        data = self.download('picture_list', verbose=verbose)
         return PictureList(data)
 
-def probe(verbose=True):
-    import traceback
+# Transports in order of preference
+transports = ('sg', 'usb', 'ip')
+lastdevicefile = os.path.join(os.path.expanduser('~'), '.cache', 'pyly', 'lastdevice.json')
 
-    try:
-        import comm_sg
-        for dev in comm_sg.probe():
-            if verbose: print(f"Opening SCSI device {dev}")
-            yield comm_sg.ScsiTarget(dev)
-    except (ImportError, IOError):
-        traceback.print_exc()
+def opendevice(kind, path):
+    "Open a target from a transport name and a device path, as found by probe"
+    target = importlib.import_module('comm_'+kind).opendevice(path)
+    target.devicepath = (kind, path)
+    return target
 
-    try:
-        import comm_usb
-        for dev in comm_usb.probe():
-            if verbose: print(f"Opening USB device {dev!r}")
-            yield comm_usb.UsbTarget(dev)
-    except (ImportError, IOError):
-        traceback.print_exc()
+def probe(verbose=True, deadline=3.0):
+    """Open the cameras found, yielding targets as they turn up.
+    Local (sg, then usb) and IP discovery run at once, each importing its
+    transports in its own thread; whatever hasn't turned up within deadline
+    seconds is given up on. Local devices are only listed by the thread and
+    opened here when they're reached, since one camera appears as both sg
+    and usb, and opening usb takes the device from the sg driver; usb
+    devices already opened through sg are skipped."""
+    found = queue.Queue()
+    def discover(kinds):
+        for kind in kinds:
+            try:
+                module = importlib.import_module('comm_'+kind)
+                for dev in module.probe():
+                    path = module.devicepath(dev)
+                    # IP cameras are found by connecting to them
+                    found.put((kind, path, opendevice(kind, path) if kind=='ip' else None))
+            except (ImportError, IOError, ValueError) as e:
+                # Reported by the consumer, so nothing prints once it has moved on
+                found.put((kind, None, e))
+        found.put(kinds)
+    groups = [('sg', 'usb'), ('ip',)]
+    for kinds in groups:
+        threading.Thread(target=discover, args=(kinds,), daemon=True).start()
+    end = time.monotonic()+deadline
+    shadowed = set()    # USB paths of cameras already opened through sg
+    while groups:
+        try:
+            result = found.get(timeout=max(0, end-time.monotonic()))
+        except queue.Empty:
+            if verbose: print(f"Gave up on {', '.join(kind for kinds in groups for kind in kinds)} discovery")
+            return
+        if result in groups:
+            groups.remove(result)
+            continue
+        kind, path, target = result
+        if path is None:
+            if verbose: print(f"No {kind} devices: {target}")
+            continue
+        if kind == 'usb' and path in shadowed:
+            if verbose: print(f"Skipping usb device {path}, already open as sg")
+            continue
+        if verbose: print(f"Opening {kind} device {path}")
+        if target is None:
+            try:
+                target = opendevice(kind, path)
+            except (IOError, ValueError) as e:
+                if verbose: print(f"Can't open {kind} device {path}: {e}")
+                continue
+        if kind == 'sg':
+            shadowed.add(importlib.import_module('comm_sg').usbpath(path))
+        yield target
 
+def loadlastdevice(path=lastdevicefile):
     try:
-        import comm_ip
-        for addr in comm_ip.probe():
-            if verbose: print(f"Connecting to IP device {addr}")
-            yield comm_ip.IpTarget(addr)
-    except (ImportError, IOError):
-        traceback.print_exc()
+        with open(path) as f:
+            return tuple(json.load(f))
+    except (OSError, ValueError):
+        return None
 
-def connect(verbose=True):
-    target = next(probe(verbose=verbose))
+def savelastdevice(device, path=lastdevicefile):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path+'.tmp', 'w') as f:
+        json.dump(device, f)
+    os.replace(path+'.tmp', path)
+
+def connect(verbose=True, deadline=3.0):
+    """Connect through a running broker (see broker.py), else to the camera
+    used last time if it's still there, otherwise to the first one found"""
+    import broker
+    if os.path.exists(broker.defaultpath):
+        try:
+            target = broker.BrokerTarget(broker.defaultpath)
+            if verbose: print(f"Using broker at {broker.defaultpath}")
+            return Lytro(target)
+        except IOError:
+            pass
+    last = loadlastdevice()
+    if last is not None:
+        try:
+            target = opendevice(*last)
+            if verbose: print(f"Opened {last[0]} device {last[1]}")
+            return Lytro(target)
+        except (ImportError, IOError, ValueError, TypeError):
+            pass
+    try:
+        target = next(probe(verbose=verbose, deadline=deadline))
+    except StopIteration:
+        raise IOError("No Lytro camera found") from None
+    savelastdevice(target.devicepath)
     return Lytro(target)
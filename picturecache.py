@@ -0,0 +1,139 @@
+# Local content-addressed picture store.
+# Pictures are named by their PictureRecord.id (a sha1 hash), so a blob we
+# already have never needs to be fetched again. Files are kept as
+# <id>.<subtype>, and file mtimes double as the LRU order for eviction.
+# Subtypes a camera doesn't have are noted as empty <id>.<subtype>.missing
+# files, and pictures evicted to keep within budget as .evicted ones, so
+# syncs don't ask for either again. Markers are never evicted.
+
+import collections
+import os
+import threading
+
+markers = ('.missing', '.evicted')
+
+class PictureCache:
+    def __init__(self, directory, budget=None):
+        "budget is the maximum total size in bytes; None means unlimited"
+        self.directory = directory
+        self.budget = budget
+        # Shared between sync workers
+        self.lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+        # filename -> size, least recently used first
+        entries = []
+        for entry in os.scandir(directory):
+            if entry.is_file() and not entry.name.endswith('.tmp'):
+                st = entry.stat()
+                entries.append((st.st_mtime, entry.name, st.st_size))
+        self.entries = collections.OrderedDict((name, size) for mtime, name, size in sorted(entries))
+        self.total = sum(self.entries.values())
+        # Files evicted so far, for sync to warn about
+        self.evictions = 0
+        with self.lock:
+            self.evict()
+    def filename(self, id, subtype):
+        return f"{id}.{subtype}"
+    def __contains__(self, key):
+        "Whether the picture is stored, known to be missing from the camera, or was evicted"
+        name = self.filename(*key)
+        with self.lock:
+            return any(name+suffix in self.entries for suffix in ('',)+markers)
+    def get(self, id, subtype):
+        "Return the cached data, or None. Raises FileNotFoundError if the camera hasn't got it."
+        name = self.filename(id, subtype)
+        with self.lock:
+            if name+'.missing' in self.entries:
+                raise FileNotFoundError(name)
+            if name not in self.entries:
+                return None
+        path = os.path.join(self.directory, name)
+        try:
+            with open(path, 'rb') as f:
+                data = bytearray(os.fstat(f.fileno()).st_size)
+                f.readinto(data)
+        except FileNotFoundError:
+            # Removed behind our back
+            with self.lock:
+                self.total -= self.entries.pop(name, 0)
+            return None
+        os.utime(path)
+        with self.lock:
+            if name in self.entries:
+                self.entries.move_to_end(name)
+        return data
+    def put(self, id, subtype, data):
+        name = self.filename(id, subtype)
+        path = os.path.join(self.directory, name)
+        # Per-thread temporary name, as several workers may share the store
+        tmp = f"{path}.{threading.get_ident()}.tmp"
+        with open(tmp, 'wb') as f:
+            f.write(data)
+        os.replace(tmp, path)
+        with self.lock:
+            self.total += len(data) - self.entries.pop(name, 0)
+            self.entries[name] = len(data)
+            for suffix in markers:
+                self.unmark(name+suffix)
+            self.evict()
+    def missing(self, id, subtype):
+        "Note that the camera hasn't got this subtype of the picture"
+        with self.lock:
+            self.mark(self.filename(id, subtype)+'.missing')
+    def mark(self, name):
+        "Create an empty marker file. Call with lock held."
+        open(os.path.join(self.directory, name), 'wb').close()
+        self.entries[name] = 0
+        self.entries.move_to_end(name)
+    def unmark(self, name):
+        "Remove a marker file if there is one. Call with lock held."
+        if self.entries.pop(name, None) is not None:
+            try:
+                os.remove(os.path.join(self.directory, name))
+            except FileNotFoundError:
+                pass
+    def evict(self):
+        """Remove least recently used pictures until we're within budget,
+        leaving .evicted markers so syncs don't fetch them back. Call with lock held."""
+        if self.budget is None or self.total <= self.budget:
+            return
+        for name in list(self.entries):
+            if self.total <= self.budget:
+                break
+            if name.endswith(markers):
+                continue
+            self.total -= self.entries.pop(name)
+            try:
+                os.remove(os.path.join(self.directory, name))
+            except FileNotFoundError:
+                pass
+            self.mark(name+'.evicted')
+            self.evictions += 1
+
+def sync(dev, cache, subtypes=('jpg', 'raw', 'txt', '128'), verbose=True, callback=None):
+    """Fetch the pictures on the camera that are missing from cache. Returns the number fetched.
+    callback(picture, subtype, size) is called after each fetch."""
+    fetched = 0
+    evictions = cache.evictions
+    for picture in dev.getpicturelist(verbose=verbose):
+        for subtype in subtypes:
+            if (picture.id, subtype) in cache:
+                continue
+            if verbose:
+                print(f"Fetching {picture.id}.{subtype}")
+            try:
+                data = dev.download('picture', picture.id, subtype, verbose=verbose)
+            except FileNotFoundError:
+                # Not every picture has every subtype; noted so the next sync doesn't ask
+                if dev.cache is not cache:
+                    cache.missing(picture.id, subtype)
+                continue
+            if dev.cache is not cache:
+                cache.put(picture.id, subtype, data)
+            fetched += 1
+            if callback:
+                callback(picture, subtype, len(data))
+    if cache.evictions > evictions:
+        print(f"Warning: the cache budget is smaller than the pictures synced; "
+              f"{cache.evictions-evictions} files were evicted and won't be synced again")
+    return fetched
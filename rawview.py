@@ -1,39 +1,159 @@
 #! /usr/bin/env python3
 
+import functools
+import json
+
 import numpy as np
 from PIL import Image
 
-def load_raw(f, w=3280, h=3280):
-    # Metadata: width, height
-    # Metadata: pixelPacking
-    arr = np.fromfile(f, np.uint8, w*h*3//2).reshape((h,w//2,3)).astype('H')
+def unpack_raw(f, w=3280, h=3280, rows=256):
+    """Unpack the sensor data in tiles of rows, yielding (y, tile).
+    f is a file (which is memory mapped) or a buffer such as an lfp section.
+    tile is a reused (rows,w) uint16 buffer, so only one tile of the image
+    is in memory at a time."""
     # Image is big endian 12 bit 2d array, bayered.
-    # This is detailed in the TXT (JSON metadata). 
-    # Bayer pattern is r,gr:gb,b but upper left pixel is blue
-    # Metadata: mosaic
-    b  = (arr[0::2,:,0]<<4 | arr[0::2,:,1]>>4) & 0xfff
-    g0 = (arr[0::2,:,1]<<8 | arr[0::2,:,2]   ) & 0xfff
-    g1 = (arr[1::2,:,0]<<4 | arr[1::2,:,1]>>4) & 0xfff
-    r  = (arr[1::2,:,1]<<8 | arr[1::2,:,2]   ) & 0xfff
-    # Subsampled RGB image for now. Just a proof of concept.
-    a = np.zeros((h//2,w//2,3))
-    a[:,:,:]=168  # black level
-    a[:,:,0] = r
-    a[:,:,1] = (g0+g1)/2   # Average since we have more green photosites
-    a[:,:,2] = b
-    # Rescale a to 0..1 levels (Metadata: pixelFormat)
-    a = (a-168)/(4095-168)
-    a = np.maximum(a, 0)
-    # White balance (Metadata: color)
-    a[:,:,0] *= 1.015625
-    a[:,:,2] *= 1.2578125
-    # Gamma (Metadata: color)
-    a **= 0.416660010814666748046875
-    a = np.minimum(a, 1.0)   # Gain may have pushed values out of range
-    
-    #print(a.max(), a.min())
+    # Metadata: pixelPacking
+    try:
+        packed = np.frombuffer(f, np.uint8, h*w*3//2).reshape((h, w*3//2))
+    except TypeError:
+        packed = np.memmap(f, np.uint8, 'r', shape=(h, w*3//2))
+    buf = np.empty((rows, w), np.uint16)
+    for y in range(0, h, rows):
+        p = packed[y:y+rows].reshape((-1, w//2, 3))
+        tile = buf[:len(p)]
+        even, odd = tile[:,0::2], tile[:,1::2]
+        np.left_shift(p[...,0], 4, out=even, dtype=np.uint16)
+        even |= p[...,1]>>4
+        np.left_shift(p[...,1]&0xf, 8, out=odd, dtype=np.uint16)
+        odd |= p[...,2]
+        yield y, tile
+
+def load_mosaic(f, w=3280, h=3280):
+    "Unpack the whole sensor image into a (h,w) uint16 Bayer mosaic"
+    mosaic = np.empty((h, w), np.uint16)
+    for y, tile in unpack_raw(f, w, h):
+        mosaic[y:y+len(tile)] = tile
+    return mosaic
+
+def find(tree, key):
+    "Depth first search of parsed JSON for key"
+    if isinstance(tree, dict):
+        if key in tree:
+            return tree[key]
+        children = tree.values()
+    elif isinstance(tree, list):
+        children = tree
+    else:
+        return None
+    for child in children:
+        found = find(child, key)
+        if found is not None:
+            return found
+    return None
+
+class RawMetadata:
+    "Sensor format and colour parameters from a picture's TXT (JSON) metadata"
+    # F01 values, used where the metadata doesn't say
+    width = height = 3280
+    black = {'r': 168, 'gr': 168, 'gb': 168, 'b': 168}
+    white = {'r': 4095, 'gr': 4095, 'gb': 4095, 'b': 4095}
+    gain = {'r': 1.015625, 'gr': 1.0, 'gb': 1.0, 'b': 1.2578125}
+    gamma = 0.416660010814666748046875
+    tile = 'r,gr:gb,b'
+    upperleft = 'b'
+    def __init__(self, data=None):
+        if data is None:
+            return
+        meta = json.loads(bytes(data) if isinstance(data, memoryview) else data)
+        self.width = find(meta, 'width') or self.width
+        self.height = find(meta, 'height') or self.height
+        # Metadata: pixelFormat
+        pixelformat = find(meta, 'pixelFormat') or {}
+        self.black = {**self.black, **pixelformat.get('black', {})}
+        self.white = {**self.white, **pixelformat.get('white', {})}
+        # Metadata: color
+        color = find(meta, 'color') or {}
+        self.gain = {**self.gain, **color.get('whiteBalanceGain', {})}
+        self.gamma = color.get('gamma', self.gamma)
+        # Metadata: mosaic
+        mosaic = find(meta, 'mosaic') or {}
+        self.tile = mosaic.get('tile', self.tile)
+        self.upperleft = mosaic.get('upperLeftPixel', self.upperleft)
+        # Metadata: pixelPacking
+        packing = find(meta, 'pixelPacking') or {}
+        if (packing.get('bitsPerPixel', 12), packing.get('endianness', 'big')) != (12, 'big'):
+            raise ValueError(f"Unsupported pixel packing: {packing}")
+    @classmethod
+    def load(cls, name):
+        with open(name, 'rb') as f:
+            return cls(f.read())
+    def sites(self):
+        "Sensor (row, column) within the 2x2 tile of each of r, gr, gb, b"
+        tile = [row.split(',') for row in self.tile.split(':')]
+        positions = {tile[y][x]: (y, x) for y in (0, 1) for x in (0, 1)}
+        oy, ox = positions[self.upperleft]
+        return {c: ((y-oy)%2, (x-ox)%2) for c, (y, x) in positions.items()}
+    def signature(self):
+        "Everything the lookup tables depend on"
+        return tuple((self.black[c], self.white[c], self.gain[c]) for c in ('r', 'gr', 'gb', 'b')) + (self.gamma,)
+
+@functools.lru_cache(maxsize=16)
+def luts(signature):
+    """(3, 8192) uint8 tables mapping sensor levels of r, g, b to output levels.
+    Tables are indexed by twice the level, so the sum of two green samples
+    indexes their average directly."""
+    (br, wr, gr), (bgr, wgr, ggr), (bgb, wgb, ggb), (bb, wb, gb), gamma = signature
+    params = ((br, wr, gr), ((bgr+bgb)/2, (wgr+wgb)/2, (ggr+ggb)/2), (bb, wb, gb))
+    level = np.arange(8192, dtype=np.float64)/2
+    tables = np.empty((3, 8192), np.uint8)
+    for table, (black, white, gain) in zip(tables, params):
+        # Rescale to 0..1 levels, white balance, gamma
+        a = np.maximum((level-black)/(white-black), 0)*gain
+        a **= gamma
+        a = np.minimum(a, 1.0)   # Gain may have pushed values out of range
+        table[:] = a*255
+    return tables
+
+def colour(a, metadata=None, out=None):
+    "Map float (...,3) RGB sensor levels to uint8 through the lookup tables"
+    tables = luts((metadata or RawMetadata()).signature())
+    if out is None:
+        out = np.empty(a.shape, np.uint8)
+    index = np.empty(a.shape[:-1], np.uint16)
+    for channel in range(3):
+        v = np.clip(a[...,channel], 0, 4095)
+        v *= 2
+        np.rint(v, out=v)
+        index[...] = v
+        out[...,channel] = tables[channel][index]
+    return out
+
+def load_raw(f, w=3280, h=3280, rows=256, metadata=None):
+    "Subsampled RGB image of a RAW file; metadata is a RawMetadata, or F01 defaults"
+    if metadata is None:
+        metadata = RawMetadata()
+    else:
+        w, h = metadata.width, metadata.height
+    sites = metadata.sites()
+    tables = luts(metadata.signature())
+    # One 2x2 mosaic tile per output pixel
+    out = np.empty((h//2, w//2, 3), np.uint8)
+    index = np.empty((rows//2, w//2), np.uint16)
+    for y, tile in unpack_raw(f, w, h, rows):
+        o = out[y//2:y//2+len(tile)//2]
+        i = index[:len(tile)//2]
+        def plane(c):
+            return tile[sites[c][0]::2, sites[c][1]::2]
+        for channel, c in (0, 'r'), (2, 'b'):
+            np.left_shift(plane(c), 1, out=i)
+            o[...,channel] = tables[channel][i]
+        # Average since we have more green photosites
+        np.add(plane('gr'), plane('gb'), out=i)
+        o[...,1] = tables[1][i]
+
+    #print(out.max(), out.min())
 
-    img = Image.frombytes('RGB', (w//2,h//2), (a*255).astype('B').tobytes())
+    img = Image.frombytes('RGB', (w//2,h//2), out)
     
     return img
 
@@ -45,4 +165,10 @@ if __name__=='__main__':
     from sys import argv
     name = argv[1] if argv[1:] else "../0001.RAW"
     #'sha1-d004cadb9917237bde5145d77d970a4b252de1e9.RAW'
-    load_raw(open(name,'rb')).show()
+    # Metadata lives next to the sensor data, e.g. sha1-....TXT
+    txt = argv[2] if argv[2:] else name.rsplit('.', 1)[0]+'.TXT'
+    try:
+        metadata = RawMetadata.load(txt)
+    except FileNotFoundError:
+        metadata = None
+    load_raw(open(name,'rb'), metadata=metadata).show()
@@ -0,0 +1,158 @@
+#! /usr/bin/env python3
+# Shift-and-add refocusing.
+# Each microlens (s,t) images the main lens aperture onto a disc of sensor
+# pixels (u,v). The gather index from sensor pixels to (v,u,t,s) only depends
+# on the microlens array calibration, so it's computed once per camera and
+# cached on disk. After one gather of the sensor data into the light field,
+# and resampling its hexagonal lens grid to a rectangular one, refocusing to
+# a new depth only shifts and sums the (v,u) sub-aperture images, which are
+# far smaller than the sensor.
+
+import hashlib
+import os
+
+import numpy as np
+from PIL import Image
+
+import rawview
+
+cachedir = os.path.join(os.path.expanduser('~'), '.cache', 'pyly')
+
+class Microlenses:
+    "Hexagonal microlens grid, rows horizontal, odd rows offset by half a lens"
+    def __init__(self, pitch, rotation=0.0, scale=(1.0, 1.0), offset=(0.0, 0.0), width=3280, height=3280):
+        "pitch and offset (x, y) of the grid centre from the sensor centre are in pixels"
+        self.pitch = pitch
+        self.rotation = rotation
+        self.scale = tuple(scale)
+        self.offset = tuple(offset)
+        self.width = width
+        self.height = height
+    @classmethod
+    def frommetadata(cls, data):
+        "Calibration from a picture's TXT (JSON) metadata (devices.mla and sensor)"
+        import json
+        meta = json.loads(bytes(data) if isinstance(data, memoryview) else data)
+        mla = rawview.find(meta, 'mla')
+        pixelpitch = rawview.find(meta, 'pixelPitch')
+        if mla is None or pixelpitch is None:
+            raise ValueError("No microlens calibration in metadata")
+        offset = mla.get('sensorOffset', {})
+        scale = mla.get('scaleFactor', {})
+        return cls(mla['lensPitch']/pixelpitch, mla.get('rotation', 0.0),
+                   (scale.get('x', 1.0), scale.get('y', 1.0)),
+                   (offset.get('x', 0.0)/pixelpitch, offset.get('y', 0.0)/pixelpitch),
+                   rawview.find(meta, 'width') or 3280, rawview.find(meta, 'height') or 3280)
+    def signature(self):
+        return (self.pitch, self.rotation, self.scale, self.offset, self.width, self.height)
+    def rowstep(self):
+        "Vertical distance between lens rows, in lens pitches"
+        return np.sqrt(3)/2*self.scale[1]/self.scale[0]
+    def centres(self):
+        "(T,S,2) array of lens centres (y, x) in sensor pixels"
+        px = self.pitch*self.scale[0]
+        py = self.pitch*np.sqrt(3)/2*self.scale[1]
+        nt, ns = int(self.height/py), int(self.width/px)
+        t, s = np.mgrid[0:nt, 0:ns].astype(np.float64)
+        # Lattice coordinates relative to the grid centre
+        x = (s - (ns-1)/2 + (t % 2)/2)*px
+        y = (t - (nt-1)//2)*py
+        c, sn = np.cos(self.rotation), np.sin(self.rotation)
+        cx = self.width/2 + self.offset[0] + c*x - sn*y
+        cy = self.height/2 + self.offset[1] + sn*x + c*y
+        return np.stack((cy, cx), axis=-1)
+    def radius(self):
+        "Largest disc of pixels safely inside each lens image"
+        return max(int(self.pitch/2)-1, 0)
+    def indexmap(self, radius=None):
+        "(V,U,T,S) int32 flat sensor indices of each lens' pixels"
+        if radius is None:
+            radius = self.radius()
+        centres = np.rint(self.centres()).astype(np.int32)
+        v, u = np.mgrid[-radius:radius+1, -radius:radius+1]
+        y = np.clip(centres[np.newaxis,np.newaxis,...,0] + v[...,np.newaxis,np.newaxis], 0, self.height-1)
+        x = np.clip(centres[np.newaxis,np.newaxis,...,1] + u[...,np.newaxis,np.newaxis], 0, self.width-1)
+        return (y*self.width + x).astype(np.int32)
+
+def indexmap(lenses, radius=None, directory=cachedir):
+    "lenses.indexmap(), cached on disk per calibration"
+    key = hashlib.sha1(repr(lenses.signature()+(radius,)).encode()).hexdigest()
+    path = os.path.join(directory, f"mla-{key}.npy")
+    try:
+        return np.load(path, mmap_mode='r')
+    except (OSError, ValueError):
+        pass
+    index = lenses.indexmap(radius)
+    os.makedirs(directory, exist_ok=True)
+    with open(path+'.tmp', 'wb') as f:
+        np.save(f, index)
+    os.replace(path+'.tmp', path)
+    return index
+
+def shiftadd(acc, weight, plane, dy, dx):
+    "acc += plane shifted by fractional (dy, dx), with bilinear weights; weight tracks coverage"
+    T, S = plane.shape[:2]
+    iy, ix = int(np.floor(dy)), int(np.floor(dx))
+    fy, fx = dy-iy, dx-ix
+    for oy, wy in (iy, 1-fy), (iy+1, fy):
+        for ox, wx in (ix, 1-fx), (ix+1, fx):
+            w = wy*wx
+            if w == 0 or abs(oy) >= T or abs(ox) >= S:
+                continue
+            dst = (slice(max(0, oy), T+min(0, oy)), slice(max(0, ox), S+min(0, ox)))
+            src = (slice(max(0, -oy), T+min(0, -oy)), slice(max(0, -ox), S+min(0, -ox)))
+            acc[dst] += w*plane[src]
+            weight[dst] += w
+
+class Refocuser:
+    def __init__(self, image, lenses, radius=None, directory=cachedir):
+        "image is a (h,w) or (h,w,C) sensor resolution array, e.g. demosaic output"
+        index = indexmap(lenses, radius, directory)
+        self.rowstep = lenses.rowstep()
+        flat = np.asarray(image, np.float32).reshape(lenses.height*lenses.width, -1)
+        # The one pass over the sensor data: gather into (V,U,T,S,C)
+        self.lightfield = flat[index]
+        # Odd lens rows sit half a lens to the right. Resample them onto the
+        # even rows' columns, one aperture pixel at a time to bound memory, so
+        # shifts apply to a rectangular grid and the image doesn't shear
+        for plane in self.lightfield:
+            odd = plane[:, 1::2]
+            odd[:, :, 1:] = 0.5*(odd[:, :, :-1] + odd[:, :, 1:])
+        r = index.shape[0]//2
+        v, u = np.mgrid[-r:r+1, -r:r+1]
+        # Only pixels within the lens disc see the aperture
+        self.apertures = [(vi, ui) for vi, ui in zip(v.ravel(), u.ravel()) if vi*vi+ui*ui <= r*r]
+    def refocus(self, shift):
+        """Image focused at the depth where each pixel of aperture offset
+        moves shift lenses; shift=0 keeps the microlens plane in focus."""
+        V, U, T, S, C = self.lightfield.shape
+        r = V//2
+        acc = np.zeros((T, S, C), np.float32)
+        weight = np.zeros((T, S, 1), np.float32)
+        for v, u in self.apertures:
+            shiftadd(acc, weight, self.lightfield[v+r, u+r], shift*v/self.rowstep, shift*u)
+        acc /= np.maximum(weight, 1e-6)
+        return acc
+    def focalstack(self, shifts):
+        return [self.refocus(shift) for shift in shifts]
+
+if __name__=='__main__':
+    import argparse
+    import demosaic
+    parser = argparse.ArgumentParser(description='Render a focal stack from a Lytro RAW file.')
+    parser.add_argument('raw', help='RAW sensor data file')
+    parser.add_argument('txt', help='TXT metadata of the same picture')
+    parser.add_argument('--shifts', default='-1,-0.5,0,0.5,1',
+                        help='Refocus shifts in lenses per aperture pixel (comma separated)')
+    parser.add_argument('--output', '-o', default='refocus-{shift}.png',
+                        help='Output file name pattern')
+    args = parser.parse_args()
+    with open(args.txt, 'rb') as f:
+        data = f.read()
+    metadata = rawview.RawMetadata(data)
+    lenses = Microlenses.frommetadata(data)
+    refocuser = Refocuser(demosaic.bilinear(rawview.load_mosaic(args.raw, lenses.width, lenses.height)), lenses)
+    shifts = [float(shift) for shift in args.shifts.split(',')]
+    for shift, a in zip(shifts, refocuser.focalstack(shifts)):
+        out = rawview.colour(a, metadata)
+        Image.frombytes('RGB', (out.shape[1], out.shape[0]), out).save(args.output.format(shift=shift))
@@ -0,0 +1,71 @@
+# Resumable downloads.
+# Received data is written to a .part file as it arrives, and a JSON sidecar
+# records which byte ranges of it are valid. A later download of the same
+# file from the same camera (by serial), of the same size, picks up at the
+# end of the contiguous prefix.
+
+import hashlib
+import json
+import os
+
+class PartialDownload:
+    def __init__(self, directory, serial, loadtype, name, subtype, size):
+        "serial is the camera's HardwareInfo.serial"
+        self.info = {'serial': serial.hex(), 'loadtype': loadtype, 'name': name, 'subtype': subtype,
+                     'size': size, 'ranges': []}
+        key = hashlib.sha1(repr((serial, loadtype, name, subtype, size)).encode()).hexdigest()
+        self.path = os.path.join(directory, key+'.part')
+        self.sidecar = self.path+'.json'
+        try:
+            with open(self.sidecar) as f:
+                info = json.load(f)
+            if all(info.get(k) == v for k, v in self.info.items() if k!='ranges'):
+                self.info['ranges'] = info['ranges']
+        except (OSError, ValueError, KeyError):
+            pass
+        os.makedirs(directory, exist_ok=True)
+        self.f = open(self.path, 'r+b' if os.path.exists(self.path) else 'w+b')
+    def __enter__(self):
+        return self
+    def __exit__(self, *exc):
+        self.close()
+    @property
+    def confirmed(self):
+        "Length of the contiguous data received from offset 0"
+        ranges = self.info['ranges']
+        return ranges[0][1] if ranges and ranges[0][0]==0 else 0
+    def readinto(self, buf):
+        "Load the confirmed prefix into buf. Returns the offset to resume from."
+        self.f.seek(0)
+        return self.f.readinto(memoryview(buf)[:self.confirmed])
+    def write(self, offset, chunk):
+        self.f.seek(offset)
+        self.f.write(chunk)
+        self.f.flush()
+        self.add(offset, offset+len(chunk))
+        self.save()
+    def add(self, start, end):
+        "Merge [start, end) into the received ranges"
+        merged = []
+        for a, b in sorted(self.info['ranges']+[[start, end]]):
+            if merged and a <= merged[-1][1]:
+                merged[-1][1] = max(merged[-1][1], b)
+            else:
+                merged.append([a, b])
+        self.info['ranges'] = merged
+    def save(self):
+        # Replace atomically so a crash never leaves a torn sidecar
+        tmp = self.sidecar+'.tmp'
+        with open(tmp, 'w') as f:
+            json.dump(self.info, f)
+        os.replace(tmp, self.sidecar)
+    def close(self):
+        self.f.close()
+    def remove(self):
+        "Discard the partial download once it is complete"
+        self.close()
+        for path in self.path, self.sidecar:
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
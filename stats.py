@@ -0,0 +1,157 @@
+# Transport instrumentation.
+# StatsTarget wraps a Target, like tuning.TunedTarget, and records for each
+# command its latency (as a log2 histogram) and the bytes moved. Lytro
+# records each whole transfer by wall time, and transports and Lytro count
+# retries, through Target.stats. Numbers can be read through the Stats API,
+# printed (test.py --stats), or passed to callbacks as each command
+# completes, for export to another metrics system.
+
+import collections
+import threading
+import time
+
+import lytro
+
+commandnames = {0xc0: 'set', 0xc2: 'load', 0xc4: 'download', 0xc6: 'query'}
+
+def commandname(command):
+    "Readable name of a 16 byte command, e.g. 'download' or 'query:battery'"
+    name = commandnames.get(command[0], f"{command[0]:#04x}")
+    if command[0] == lytro.LytroQuery.command:
+        query = lytro.LytroQueries.get(command[2])
+        name += ':' + (query.__name__[len('LytroQuery'):].lower() if query else str(command[2]))
+    return name
+
+class CommandStats:
+    "Count, bytes and latency histogram of one kind of command"
+    def __init__(self):
+        self.count = 0
+        self.bytes = 0
+        self.seconds = 0.0
+        self.maximum = 0.0
+        # histogram[i] counts latencies below 2**i microseconds
+        self.histogram = [0]*32
+    def add(self, seconds, nbytes):
+        self.count += 1
+        self.bytes += nbytes
+        self.seconds += seconds
+        self.maximum = max(self.maximum, seconds)
+        self.histogram[min(int(seconds*1e6).bit_length(), 31)] += 1
+    def percentile(self, p):
+        "Upper bound in seconds of the latency below which fraction p of commands fall"
+        remaining = p*self.count
+        for bucket, n in enumerate(self.histogram):
+            remaining -= n
+            if remaining <= 0:
+                return min((1<<bucket)/1e6, self.maximum)
+        return self.maximum
+    def throughput(self):
+        "Bytes per second spent in these commands"
+        return self.bytes/self.seconds if self.seconds else 0.0
+    def asdict(self):
+        return {'count': self.count, 'bytes': self.bytes, 'seconds': self.seconds,
+                'max': self.maximum, 'p50': self.percentile(0.5), 'p99': self.percentile(0.99),
+                'histogram': {1<<i: n for i, n in enumerate(self.histogram) if n}}
+
+class Stats:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.commands = collections.defaultdict(CommandStats)
+        self.retries = collections.Counter()
+        # Whole downloads by wall time; their commands overlap when pipelined
+        self.transfers = CommandStats()
+        self.started = time.perf_counter()
+        # Called with (name, seconds, bytes) for each command and
+        # ('transfer', seconds, bytes) for each transfer, and
+        # ('retry:'+kind, 0.0, 0) for each retry
+        self.callbacks = []
+    def record(self, command, seconds, nbytes):
+        name = commandname(command)
+        with self.lock:
+            self.commands[name].add(seconds, nbytes)
+        for callback in self.callbacks:
+            callback(name, seconds, nbytes)
+    def transfer(self, seconds, nbytes):
+        with self.lock:
+            self.transfers.add(seconds, nbytes)
+        for callback in self.callbacks:
+            callback('transfer', seconds, nbytes)
+    def retry(self, kind):
+        with self.lock:
+            self.retries[kind] += 1
+        for callback in self.callbacks:
+            callback('retry:'+kind, 0.0, 0)
+    def elapsed(self):
+        return time.perf_counter()-self.started
+    def throughput(self):
+        "Bytes per second moved since the stats were started"
+        return sum(command.bytes for command in self.commands.values())/self.elapsed()
+    def snapshot(self):
+        "Everything recorded so far, as plain data"
+        with self.lock:
+            return {'elapsed': self.elapsed(), 'throughput': self.throughput(),
+                    'commands': {name: command.asdict() for name, command in self.commands.items()},
+                    'transfers': self.transfers.asdict(),
+                    'retries': dict(self.retries)}
+    def report(self):
+        with self.lock:
+            lines = [f"{'command':16} {'count':>7} {'bytes':>11} {'MB/s':>7} {'p50 ms':>8} {'p99 ms':>8} {'max ms':>8}"]
+            # Only whole transfers get MB/s; pipelined commands' seconds overlap
+            rows = sorted(self.commands.items())
+            if self.transfers.count:
+                rows.append(('transfer', self.transfers))
+            for name, command in rows:
+                mbs = f"{command.throughput()/1e6:7.2f}" if command is self.transfers else f"{'':7}"
+                lines.append(f"{name:16} {command.count:7} {command.bytes:11} {mbs} "
+                             f"{command.percentile(0.5)*1e3:8.2f} {command.percentile(0.99)*1e3:8.2f} "
+                             f"{command.maximum*1e3:8.2f}")
+            for kind, n in sorted(self.retries.items()):
+                lines.append(f"retries ({kind}): {n}")
+            lines.append(f"{self.throughput()/1e6:.2f} MB/s over {self.elapsed():.2f}s")
+        return '\n'.join(lines)
+
+class StatsTarget:
+    "Wraps a Target, recording each command in a Stats"
+    def __init__(self, target, stats=None):
+        self.target = target
+        self.stats = Stats() if stats is None else stats
+        # Let the transport, and any wrappers in between, count their retries
+        inner = target
+        while inner is not None:
+            inner.stats = self.stats
+            inner = vars(inner).get('target')
+    def __getattr__(self, name):
+        return getattr(self.target, name)
+    def read(self, command, size):
+        start = time.perf_counter()
+        data = self.target.read(command, size)
+        self.stats.record(command, time.perf_counter()-start, len(data) if data else 0)
+        return data
+    def readinto(self, command, buf):
+        start = time.perf_counter()
+        received = self.target.readinto(command, buf)
+        self.stats.record(command, time.perf_counter()-start, received)
+        return received
+    def write(self, command, data):
+        start = time.perf_counter()
+        result = self.target.write(command, data)
+        self.stats.record(command, time.perf_counter()-start, len(data))
+        return result
+    def readmany(self, requests):
+        # Latency of a pipelined command runs from when the transport takes it
+        sent = {}
+        def stamped():
+            for request in requests:
+                if request is not None:
+                    sent[id(request)] = time.perf_counter()
+                yield request
+        for request, received in self.target.readmany(stamped()):
+            self.stats.record(request[0], time.perf_counter()-sent.pop(id(request)), received)
+            yield request, received
+
+def instrument(dev, callback=None):
+    "Record dev's transport use. Returns the Stats."
+    dev.comm = StatsTarget(dev.comm)
+    if callback is not None:
+        dev.comm.stats.callbacks.append(callback)
+    return dev.comm.stats
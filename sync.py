@@ -0,0 +1,95 @@
+#! /usr/bin/env python3
+# Bulk picture sync from every attached camera at once.
+# Each camera gets its own worker thread; the transports spend their time in
+# ioctl/socket/USB calls which release the GIL, so threads scale with devices.
+# All workers share one content-addressed picture store, so the output tree
+# is the same whichever camera a picture came from.
+
+import concurrent.futures
+import threading
+import time
+
+import lytro
+import picturecache
+
+class Progress:
+    "Per-device and aggregate transfer statistics"
+    def __init__(self, verbose=True):
+        self.verbose = verbose
+        self.lock = threading.Lock()
+        self.start = time.monotonic()
+        self.devices = {}   # name -> [pictures, bytes, start time]
+    def begin(self, device):
+        with self.lock:
+            self.devices[device] = [0, 0, time.monotonic()]
+    def update(self, device, picture, subtype, size):
+        with self.lock:
+            stats = self.devices[device]
+            stats[0] += 1
+            stats[1] += size
+            if self.verbose:
+                rate = stats[1]/(time.monotonic()-stats[2])/1e6
+                print(f"{device}: {picture.id}.{subtype} ({stats[0]} files, {rate:.2f} MB/s); "
+                      f"total {self.throughput():.2f} MB/s", flush=True)
+    def throughput(self):
+        "Aggregate MB/s over all devices"
+        return sum(stats[1] for stats in self.devices.values())/(time.monotonic()-self.start)/1e6
+    def report(self):
+        with self.lock:
+            elapsed = time.monotonic()-self.start
+            for device, (files, size, start) in self.devices.items():
+                print(f"{device}: {files} files, {size} bytes")
+            files = sum(stats[0] for stats in self.devices.values())
+            print(f"Total: {files} files in {elapsed:.1f}s, {self.throughput():.2f} MB/s")
+
+def syncdevice(dev, device, cache, subtypes, progress):
+    "Worker: sync one camera into cache. Returns (device name, files fetched)."
+    progress.begin(device)
+    callback = lambda picture, subtype, size: progress.update(device, picture, subtype, size)
+    return device, picturecache.sync(dev, cache, subtypes, verbose=False, callback=callback)
+
+def syncall(directory, subtypes=('jpg', 'raw', 'txt', '128'), budget=None, verbose=True):
+    "Sync all probed cameras into the picture store in directory. Returns {device: files fetched}."
+    cache = picturecache.PictureCache(directory, budget)
+    # One Lytro per camera: the same one can turn up on more than one transport
+    devices = {}
+    for target in lytro.probe(verbose=verbose):
+        dev = lytro.Lytro(target, cache=cache)
+        try:
+            device = dev.gethardwareinfo(verbose=False).serial.decode('ascii', 'replace')
+        except (IOError, AssertionError) as e:
+            print(f"Can't identify {getattr(target, 'devicepath', target)}: {e!r}")
+            continue
+        if device in devices:
+            if verbose: print(f"{device}: already found, skipping {getattr(target, 'devicepath', target)}")
+            continue
+        devices[device] = dev
+    if not devices:
+        raise IOError("No Lytro cameras found")
+    progress = Progress(verbose)
+    results = {}
+    with concurrent.futures.ThreadPoolExecutor(max_workers=len(devices)) as pool:
+        futures = [pool.submit(syncdevice, dev, device, cache, subtypes, progress)
+                   for device, dev in devices.items()]
+        for future in concurrent.futures.as_completed(futures):
+            try:
+                device, fetched = future.result()
+            except (IOError, AssertionError) as e:
+                # One misbehaving camera shouldn't stop the rest
+                print(f"Sync failed: {e!r}")
+                continue
+            results[device] = fetched
+    if verbose:
+        progress.report()
+    return results
+
+if __name__=='__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description='Sync pictures from all attached Lytro F01 cameras.')
+    parser.add_argument('directory', help='Picture store directory')
+    parser.add_argument('--types', default='jpg,raw,txt,128',
+                        help='Picture subtypes to sync (comma separated)')
+    parser.add_argument('--budget', type=int, metavar='MIB',
+                        help='Size limit of the picture store; least recently used pictures are evicted')
+    args = parser.parse_args()
+    syncall(args.directory, args.types.split(','), args.budget<<20 if args.budget else None)
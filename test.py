@@ -18,12 +18,28 @@ def main():
                         help='Check camera time')
     parser.add_argument('--hardwareinfo', action='store_true',
                         help='Check hardware info')
+    parser.add_argument('--calibration', action='store_true',
+                        help='Fetch calibration data into the local calibration store')
     parser.add_argument('--listpictures', action='store_true',
                         help='List pictures')
     parser.add_argument('--output', '-o', type=argparse.FileType('wb'),
                         help='Output filename')
     parser.add_argument('--download-file',
                         help='Download file')
+    parser.add_argument('--tune', action='store_true',
+                        help='Pick the fastest transfer size, remembered per camera')
+    parser.add_argument('--partial-dir',
+                        help='Keep partial downloads here so they can be resumed')
+    parser.add_argument('--sync', metavar='DIR',
+                        help='Fetch pictures missing from the local picture store in DIR')
+    parser.add_argument('--sync-types', default='jpg,raw,txt,128',
+                        help='Picture subtypes to sync (comma separated)')
+    parser.add_argument('--all-devices', action='store_true',
+                        help='Sync all attached cameras concurrently')
+    parser.add_argument('--cache-budget', type=int, metavar='MIB',
+                        help='Size limit of the picture store; least recently used pictures are evicted')
+    parser.add_argument('--stats', action='store_true',
+                        help='Print per command latency, bytes and retries when done')
     downloadtypes = list(lytro.loadtypes.keys())
     downloadtypes.remove('picture')
     downloadtypes.extend(lytro.picturesubtypes)
@@ -37,8 +53,24 @@ def main():
         list(lytro.probe(verbose=True))
         return
 
+    budget = args.cache_budget<<20 if args.cache_budget else None
+    if args.sync and args.all_devices:
+        import sync
+        sync.syncall(args.sync, args.sync_types.split(','), budget)
+        return
+
     # Connect to the first found Lytro camera
     dev = lytro.connect()
+    dev.partialdir = args.partial_dir
+    if args.tune:
+        import tuning
+        tuning.tune(dev)
+    if args.stats:
+        import stats
+        transportstats = stats.instrument(dev)
+    if args.sync:
+        import picturecache
+        dev.cache = picturecache.PictureCache(args.sync, budget)
 
     if args.battery:
         battery = dev.getbattery()
@@ -52,11 +84,20 @@ def main():
         info = dev.gethardwareinfo()
         print(info)
 
+    if args.calibration:
+        import calibration
+        cal = dev.getcalibration(calibration.CalibrationStore())
+        print(f"Calibration: {cal}")
+
     if args.listpictures:
         # TODO: Sane format! This doesn't describe them at all
         for picture in dev.getpicturelist():
             print(picture)
     
+    if args.sync:
+        fetched = picturecache.sync(dev, dev.cache, args.sync_types.split(','))
+        print(f"Fetched {fetched} new pictures")
+
     if args.output:
         with args.output as f:
             if args.download_type in lytro.picturesubtypes:
@@ -65,8 +106,11 @@ def main():
             else:
                 dt = args.download_type
                 subtype = None
-            data = dev.download(dt, args.download_file, subtype=subtype)
-            f.write(data)
+            # Stream to disk so writes overlap the transfer
+            dev.download_to(f, dt, args.download_file, subtype=subtype)
+
+    if args.stats:
+        print(transportstats.report())
 
     return
 
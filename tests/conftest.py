@@ -0,0 +1,25 @@
+# The modules live at the top of the repository, not in a package
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import emulator
+
+@pytest.fixture
+def camera():
+    "Emulated camera with small RAWs, so tests stay fast"
+    return emulator.Camera(pictures=2, rawsize=300000)
+
+@pytest.fixture
+def server(camera):
+    with emulator.Emulator(camera) as server:
+        yield server
+
+def picture(camera, index=0, subtype='raw'):
+    "(id, contents) of a picture on an emulated camera"
+    import lytro
+    id = camera.ids[index]
+    return id, camera.files[lytro.loadtypes['picture'], id+chr(lytro.picturesubtypes.index(subtype))]
@@ -0,0 +1,95 @@
+import os
+import socket
+import tempfile
+import threading
+
+import pytest
+
+import broker
+import comm_ip
+import lytro
+from conftest import picture
+
+@pytest.fixture
+def socketpath():
+    # Unix socket paths are short; pytest's tmp_path can be too long
+    with tempfile.TemporaryDirectory() as directory:
+        yield os.path.join(directory, 'broker.sock')
+
+@pytest.fixture
+def served(server, socketpath):
+    b = broker.Broker(comm_ip.IpTarget(server.address, timeout=5, window=4), socketpath)
+    thread = threading.Thread(target=b.serve_forever, daemon=True)
+    thread.start()
+    yield b
+    b.shutdown()
+    b.server_close()
+    thread.join()
+
+def test_download(served, server, camera, socketpath):
+    dev = broker.connect(socketpath)
+    assert dev.comm.window == 4
+    assert [picture.id for picture in dev.getpicturelist(verbose=False)] == camera.ids
+    assert dev.gethardwareinfo(verbose=False).serial == b'EMU0000001'
+    id, data = picture(camera)
+    assert dev.download('picture', id, 'raw', verbose=False) == data
+
+def test_clients(served, camera, socketpath):
+    results = {}
+    def fetch(index):
+        dev = broker.connect(socketpath)
+        id, data = picture(camera, index)
+        for subtype in ('raw', 'jpg', 'txt'):
+            results[index, subtype] = dev.download('picture', id, subtype, verbose=False) == picture(camera, index, subtype)[1]
+    threads = [threading.Thread(target=fetch, args=(i%2,)) for i in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert len(results) == 6 and all(results.values())
+
+def test_battery_during_download(served, camera, socketpath):
+    dev = broker.connect(socketpath)
+    other = broker.connect(socketpath)
+    id, data = picture(camera)
+    batteries = []
+    done = threading.Event()
+    def query():
+        while not done.is_set():
+            batteries.append(other.getbattery())
+    thread = threading.Thread(target=query)
+    thread.start()
+    try:
+        received = dev.download('picture', id, 'raw', verbose=False)
+    finally:
+        done.set()
+        thread.join()
+    assert received == data
+    assert batteries and set(batteries) == {camera.battery}
+
+def test_error_keeps_order(served, server, camera, socketpath):
+    dev = broker.connect(socketpath)
+    server.link.disconnect = 1.0
+    with pytest.raises(IOError):
+        dev.download('picture', camera.ids[0], 'raw', verbose=False)
+    server.link.disconnect = 0
+    # Replies after the error line up with their requests
+    assert dev.getbattery() == camera.battery
+    id, data = picture(camera, 1)
+    assert dev.download('picture', id, 'raw', verbose=False) == data
+
+def test_stale_socket(server, socketpath):
+    s = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    s.bind(socketpath)
+    s.close()
+    assert broker.stale(socketpath)
+    b = broker.Broker(comm_ip.IpTarget(server.address, timeout=5), socketpath)
+    try:
+        assert not broker.stale(socketpath)
+        # A live broker's socket is left alone
+        with pytest.raises(OSError):
+            broker.Broker(comm_ip.IpTarget(server.address, timeout=5), socketpath)
+        assert os.path.exists(socketpath)
+    finally:
+        b.server_close()
+    assert not os.path.exists(socketpath)
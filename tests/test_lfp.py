@@ -0,0 +1,48 @@
+import json
+
+import pytest
+
+import lfp
+
+def section(magic, ref, data):
+    return (lfp.header.pack(magic, b'\0\0\0\1', len(data)) + ref.encode('ascii').ljust(lfp.refsize, b'\0')
+            + data + bytes(-len(data)%16))
+
+def container(toc, sections):
+    return (lfp.header.pack(lfp.filemagic, b'\0\0\0\1', 0)
+            + section(b'\x89LFM\r\n\x1a\n', 'sha1-toc', json.dumps(toc).encode('ascii'))
+            + b''.join(section(b'\x89LFC\r\n\x1a\n', ref, data) for ref, data in sections))
+
+def test_scan():
+    # Lengths that do and don't need padding
+    data = container({}, [('sha1-a', b'a'*5), ('sha1-b', b'b'*32)])
+    sections = list(lfp.scan(data))
+    assert [(s.type, s.ref, s.length) for s in sections] == [('LFM', 'sha1-toc', 2), ('LFC', 'sha1-a', 5), ('LFC', 'sha1-b', 32)]
+    assert data[sections[1].offset:sections[1].offset+5] == b'a'*5
+    assert data[sections[2].offset:sections[2].offset+32] == b'b'*32
+
+def test_concatenated():
+    data = container({}, [('sha1-a', b'a')]) + container({}, [('sha1-b', b'b')])
+    assert [s.ref for s in lfp.scan(data)] == ['sha1-toc', 'sha1-a', 'sha1-toc', 'sha1-b']
+
+def test_bad():
+    with pytest.raises(ValueError):
+        list(lfp.scan(bytes(256)))
+    data = container({}, [('sha1-a', b'a')])
+    with pytest.raises(ValueError):
+        list(lfp.scan(data + b'\x89XXX\r\n\x1a\n' + bytes(100)))
+
+def test_file(tmp_path):
+    toc = {'picture': {'frameArray': [{'frame': {'metadataRef': 'sha1-meta', 'imageRef': 'sha1-raw'}}]}}
+    meta = json.dumps({'image': {'width': 2}}).encode('ascii')
+    path = tmp_path / 'raw.lfp'
+    path.write_bytes(container(toc, [('sha1-meta', meta), ('sha1-raw', b'\1\2\3'), ('sha1-tn', bytes(128*128*2))]))
+    f = lfp.LfpFile(str(path))
+    assert f.toc() == toc
+    with f.metadata() as v:
+        assert bytes(v) == meta
+    with f.image() as v:
+        assert bytes(v) == b'\1\2\3'
+    with f.thumbnail() as v:
+        assert len(v) == 128*128*2
+    f.close()
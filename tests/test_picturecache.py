@@ -0,0 +1,63 @@
+import os
+
+import pytest
+
+import comm_ip
+import lytro
+import picturecache
+
+def connect(server):
+    return lytro.Lytro(comm_ip.IpTarget(server.address, timeout=5))
+
+def test_sync(server, camera, tmp_path):
+    cache = picturecache.PictureCache(str(tmp_path))
+    dev = connect(server)
+    fetched = []
+    assert picturecache.sync(dev, cache, verbose=False,
+                             callback=lambda picture, subtype, size: fetched.append((picture.id, subtype))) == 8
+    assert len(fetched) == 8
+    for id in camera.ids:
+        for subtype in ('jpg', 'raw', 'txt', '128'):
+            assert cache.get(id, subtype) == camera.files[lytro.loadtypes['picture'], id+chr(lytro.picturesubtypes.index(subtype))]
+    # Nothing new on the camera, nothing to fetch; a fresh store sees the same files
+    assert picturecache.sync(dev, picturecache.PictureCache(str(tmp_path)), verbose=False) == 0
+
+def test_missing(server, camera, tmp_path):
+    cache = picturecache.PictureCache(str(tmp_path))
+    dev = connect(server)
+    assert picturecache.sync(dev, cache, subtypes=('jpg', 'stk'), verbose=False) == 2
+    assert (tmp_path / f"{camera.ids[0]}.stk.missing").exists()
+    assert picturecache.sync(dev, cache, subtypes=('jpg', 'stk'), verbose=False) == 0
+    with pytest.raises(FileNotFoundError):
+        cache.get(camera.ids[0], 'stk')
+    # Turning up later replaces the marker
+    cache.put(camera.ids[0], 'stk', b'stack')
+    assert cache.get(camera.ids[0], 'stk') == b'stack'
+    assert not (tmp_path / f"{camera.ids[0]}.stk.missing").exists()
+
+def test_budget(server, camera, tmp_path, capsys):
+    # Room for one RAW, not two
+    cache = picturecache.PictureCache(str(tmp_path), budget=400000)
+    dev = connect(server)
+    assert picturecache.sync(dev, cache, subtypes=('raw',), verbose=False) == 2
+    assert "1 files were evicted" in capsys.readouterr().out
+    assert cache.total <= cache.budget
+    assert cache.get(camera.ids[0], 'raw') is None
+    assert (tmp_path / f"{camera.ids[0]}.raw.evicted").exists()
+    # Evicted files aren't fetched back on the next sync
+    assert picturecache.sync(dev, cache, subtypes=('raw',), verbose=False) == 0
+    # Markers survive a restart, and aren't evicted themselves
+    cache = picturecache.PictureCache(str(tmp_path), budget=400000)
+    assert (camera.ids[0], 'raw') in cache
+    assert picturecache.sync(dev, cache, subtypes=('raw',), verbose=False) == 0
+
+def test_lru(tmp_path):
+    cache = picturecache.PictureCache(str(tmp_path), budget=250)
+    cache.put('a', 'jpg', bytes(100))
+    cache.put('b', 'jpg', bytes(100))
+    # Reading a makes b the least recently used
+    assert cache.get('a', 'jpg') == bytes(100)
+    cache.put('c', 'jpg', bytes(100))
+    assert cache.get('b', 'jpg') is None
+    assert cache.get('a', 'jpg') == bytes(100)
+    assert sorted(os.listdir(tmp_path)) == ['a.jpg', 'b.jpg.evicted', 'c.jpg']
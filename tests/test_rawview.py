@@ -0,0 +1,29 @@
+import numpy as np
+
+import rawview
+
+def pack(pixels):
+    "12 bit big endian packing of a (h,w) array, 3 bytes per 2 pixels"
+    even, odd = pixels[:,0::2].astype(np.uint32), pixels[:,1::2].astype(np.uint32)
+    packed = np.empty(even.shape+(3,), np.uint8)
+    packed[...,0] = even>>4
+    packed[...,1] = (even&0xf)<<4 | odd>>8
+    packed[...,2] = odd&0xff
+    return packed.tobytes()
+
+def test_unpack():
+    pixels = np.random.default_rng(0).integers(0, 1<<12, (10, 8), np.uint16)
+    assert pack(np.array([[0xabc, 0x123]])) == b'\xab\xc1\x23'
+    data = pack(pixels)
+    tiles = [(y, tile.copy()) for y, tile in rawview.unpack_raw(data, 8, 10, rows=4)]
+    # The last tile is short
+    assert [(y, len(tile)) for y, tile in tiles] == [(0, 4), (4, 4), (8, 2)]
+    assert (np.concatenate([tile for y, tile in tiles]) == pixels).all()
+    assert (rawview.load_mosaic(data, 8, 10) == pixels).all()
+
+def test_mapped(tmp_path):
+    pixels = np.random.default_rng(1).integers(0, 1<<12, (6, 4), np.uint16)
+    path = tmp_path / 'IMG_0001.RAW'
+    path.write_bytes(pack(pixels))
+    with open(path, 'rb') as f:
+        assert (rawview.load_mosaic(f, 4, 6) == pixels).all()
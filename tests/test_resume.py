@@ -0,0 +1,75 @@
+import struct
+
+import pytest
+
+import comm_ip
+import emulator
+import lytro
+import resume
+from conftest import picture
+
+def connect(server, tmp_path):
+    dev = lytro.Lytro(comm_ip.IpTarget(server.address, timeout=5), partialdir=str(tmp_path))
+    # Known serial, so faults below only hit the picture download
+    dev.serial = dev.gethardwareinfo(verbose=False).serial
+    return dev
+
+def test_resume_after_disconnect(server, camera, tmp_path, capsys):
+    dev = connect(server, tmp_path)
+    id, data = picture(camera)
+    server.link.disconnect = 0.3
+    for attempt in range(20):
+        try:
+            received = dev.download('picture', id, 'raw')
+            break
+        except IOError:
+            dev.comm.reconnect()
+    else:
+        pytest.fail("download never completed")
+    assert received == data
+    assert "Resuming download at" in capsys.readouterr().out
+    # Finished downloads leave nothing behind
+    assert not list(tmp_path.iterdir())
+
+def test_resume_uses_partial(server, camera, tmp_path, capsys):
+    dev = connect(server, tmp_path)
+    id, data = picture(camera)
+    # A prefix that differs from the camera's shows it wasn't downloaded again
+    with resume.PartialDownload(str(tmp_path), dev.serial, 'picture', id, 'raw', len(data)) as part:
+        part.write(0, bytes(1000))
+    received = dev.download('picture', id, 'raw')
+    assert "Resuming download at 1000/" in capsys.readouterr().out
+    assert received[:1000] == bytes(1000)
+    assert received[1000:] == data[1000:]
+
+def test_other_camera(camera, tmp_path, capsys):
+    id, data = picture(camera)
+    with resume.PartialDownload(str(tmp_path), b'EMU0000001', 'picture', id, 'raw', len(data)) as part:
+        part.write(0, bytes(1000))
+    camera.files[lytro.loadtypes['hardware_info'], None] = struct.pack(
+        '256s128s128s128s4s', b'Lytro, Inc.', b'EMU0000002', b'emulator', b'1.0', b'')
+    with emulator.Emulator(camera) as server:
+        dev = connect(server, tmp_path)
+        assert dev.download('picture', id, 'raw') == data
+    assert "Resuming" not in capsys.readouterr().out
+
+def test_files_not_resumed(server, camera, tmp_path, capsys):
+    dev = connect(server, tmp_path)
+    path, data = next((name, data) for (loadtype, name), data in camera.files.items()
+                      if loadtype == lytro.loadtypes['file'] and name.endswith('.RAW'))
+    with resume.PartialDownload(str(tmp_path), dev.serial, 'file', path, None, len(data)) as part:
+        part.write(0, bytes(1000))
+    assert dev.download('file', path) == data
+    assert "Resuming" not in capsys.readouterr().out
+
+def test_ranges(tmp_path):
+    with resume.PartialDownload(str(tmp_path), b'EMU0000001', 'picture', 'id', 'raw', 100) as part:
+        part.write(20, b'x'*10)
+        assert part.confirmed == 0
+        part.write(0, b'y'*20)
+        assert part.confirmed == 30
+    # The sidecar carries the ranges over to the next session
+    with resume.PartialDownload(str(tmp_path), b'EMU0000001', 'picture', 'id', 'raw', 100) as part:
+        buf = bytearray(100)
+        assert part.readinto(buf) == 30
+        assert buf[:30] == b'y'*20 + b'x'*10
@@ -0,0 +1,79 @@
+import io
+
+import pytest
+
+import comm_ip
+import lytro
+import stats
+from conftest import picture
+
+@pytest.mark.parametrize('window', [1, 4])
+def test_download(server, camera, window):
+    dev = lytro.Lytro(comm_ip.IpTarget(server.address, timeout=5, window=window))
+    for subtype in ('jpg', 'raw', 'txt', '128'):
+        id, data = picture(camera, subtype=subtype)
+        assert dev.download('picture', id, subtype, verbose=False) == data
+
+def test_streamed(server, camera):
+    dev = lytro.Lytro(comm_ip.IpTarget(server.address, timeout=5))
+    id, data = picture(camera)
+    assert b''.join(bytes(chunk) for chunk in dev.iterdownload('picture', id, 'raw', verbose=False)) == data
+    f = io.BytesIO()
+    assert dev.download_to(f, 'picture', id, 'raw', verbose=False) == len(data)
+    assert f.getvalue() == data
+
+def test_picturelist(server, camera):
+    dev = lytro.Lytro(comm_ip.IpTarget(server.address, timeout=5))
+    assert [picture.id for picture in dev.getpicturelist(verbose=False)] == camera.ids
+    assert dev.gethardwareinfo(verbose=False).serial == b'EMU0000001'
+
+def test_missing(server, camera):
+    dev = lytro.Lytro(comm_ip.IpTarget(server.address, timeout=5))
+    with pytest.raises(FileNotFoundError):
+        dev.download('picture', camera.ids[0], 'stk', verbose=False)
+
+@pytest.mark.parametrize('window', [1, 4])
+def test_short_replies(server, camera, window):
+    server.link.short = server.link.empty = 0.2
+    dev = lytro.Lytro(comm_ip.IpTarget(server.address, timeout=5, window=window))
+    transportstats = stats.instrument(dev)
+    id, data = picture(camera)
+    assert dev.download('picture', id, 'raw', verbose=False) == data
+    if window > 1:
+        assert transportstats.retries['short']
+
+@pytest.mark.parametrize('window', [1, 4])
+def test_empty_replies(server, camera, window):
+    server.link.empty = 1.0
+    dev = lytro.Lytro(comm_ip.IpTarget(server.address, timeout=5, window=window))
+    with pytest.raises(IOError, match='No data'):
+        dev.download('picture', camera.ids[0], 'raw', verbose=False)
+
+def test_pipeline_error_reconnects(server, camera):
+    target = comm_ip.IpTarget(server.address, timeout=5, window=4)
+    dev = lytro.Lytro(target)
+    server.link.disconnect = 0.3
+    with pytest.raises(IOError):
+        dev.download('picture', camera.ids[0], 'raw', verbose=False)
+    server.link.disconnect = 0
+    # Unpipelined on a fresh connection, and in step again
+    assert target.window == 1
+    assert dev.getbattery() == camera.battery
+    id, data = picture(camera)
+    assert dev.download('picture', id, 'raw', verbose=False) == data
+
+def test_abandoned_pipeline(server, camera):
+    target = comm_ip.IpTarget(server.address, timeout=5, window=4)
+    dev = lytro.Lytro(target)
+    id, data = picture(camera)
+    size = dev.load('picture', id, 'raw')
+    buf = bytearray(size)
+    def requests():
+        dl = lytro.LytroDownload(size)
+        for offset in range(0, size, target.maxtransfer):
+            dl.offset = offset
+            yield dl.pack(), memoryview(buf)[offset:offset+target.maxtransfer]
+    replies = target.readmany(requests())
+    next(replies)
+    replies.close()
+    assert dev.getbattery() == camera.battery
@@ -1,25 +1,47 @@
 # Thumbnails are 128x128, 16 bits per pixel.
 # Guessed YUYV, aka interleaved YUV 4:2:2.
 
+import numpy as np
 from PIL import Image
 
-def decode_tn128(data):
+w,h=128,128
+
+def tn128_array(data):
+    "Decode a thumbnail into a (128,128,3) uint8 YCbCr array"
     # My download may have added an extra byte.
     if len(data)%2:
         assert data[-1]==0
         data = data[:-1]
-    w,h=128,128
-
-    img = Image.new('YCbCr', (w,h))
-    for y in range(h):
-        for x in range(0,w,2):
-            cb = data[(y*w+x)*2+1]
-            cr = data[(y*w+x)*2+3]
-            cy = data[(y*w+x)*2]
-            img.putpixel((x,y), (cy,cb,cr))
-            cy = data[(y*w+x)*2+2]
-            img.putpixel((x+1,y), (cy,cb,cr))
-    return img
+    return ycbcr(np.frombuffer(data, np.uint8, w*h*2).reshape((1,h,w//2,4)))[0]
+
+def ycbcr(yuyv):
+    "Expand (N,h,w/2,4) Y0,Cb,Y1,Cr macropixels into (N,h,w,3) YCbCr"
+    n = yuyv.shape[0]
+    out = np.empty((n,h,w//2,2,3), np.uint8)
+    out[...,0,0] = yuyv[...,0]
+    out[...,1,0] = yuyv[...,2]
+    # Both pixels of a pair share the chroma samples
+    out[...,1:] = yuyv[...,np.newaxis,1::2]
+    return out.reshape((n,h,w,3))
+
+def ycbcr_to_rgb(a):
+    "JPEG (full range BT.601) YCbCr to RGB, as PIL does"
+    y = a[...,0].astype(np.float32)
+    cb = a[...,1].astype(np.float32)-128
+    cr = a[...,2].astype(np.float32)-128
+    rgb = np.stack((y+1.402*cr, y-0.344136*cb-0.714136*cr, y+1.772*cb), axis=-1)
+    return np.clip(rgb+0.5, 0, 255).astype(np.uint8)
+
+def decode_tn128_batch(thumbnails, rgb=False):
+    "Decode many thumbnails into one (N,128,128,3) uint8 array, YCbCr unless rgb is set"
+    yuyv = np.empty((len(thumbnails),h,w//2,4), np.uint8)
+    for i, data in enumerate(thumbnails):
+        yuyv[i].reshape(-1)[:] = np.frombuffer(data, np.uint8, w*h*2)
+    a = ycbcr(yuyv)
+    return ycbcr_to_rgb(a) if rgb else a
+
+def decode_tn128(data):
+    return Image.frombytes('YCbCr', (w,h), tn128_array(data).tobytes())
 
 if __name__ == '__main__':
     def main():
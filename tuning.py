@@ -0,0 +1,126 @@
+# Transfer size tuning.
+# Each transport lists the chunk sizes worth trying in transfersizes.
+# TunedTarget tries them in turn on the first download chunks, drops sizes
+# the camera refuses, and settles on the one with the best throughput.
+# The result is remembered per camera serial and transport, so later
+# sessions start at the right size straight away.
+
+import collections
+import json
+import os
+import time
+
+import lytro
+
+cachefile = os.path.join(os.path.expanduser('~'), '.cache', 'pyly', 'transfersizes.json')
+
+def loadsizes(path=cachefile):
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+def savesizes(sizes, path=cachefile):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path+'.tmp', 'w') as f:
+        json.dump(sizes, f, indent=1)
+    os.replace(path+'.tmp', path)
+
+class TunedTarget:
+    "Wraps a Target, picking its maxtransfer by measuring download chunks"
+    def __init__(self, target, key, samples=3, path=cachefile):
+        self.target = target
+        self.key = key
+        self.samples = samples
+        self.path = path
+        self.candidates = sorted(target.transfersizes)
+        self.results = {}   # size -> [bytes, seconds, chunks]
+        self.skipped = collections.Counter()   # size -> chunks too small to try it
+        best = loadsizes(path).get(key)
+        self.settled = best is not None
+        if self.settled:
+            target.maxtransfer = best
+    def __getattr__(self, name):
+        return getattr(self.target, name)
+    def read(self, command, size):
+        return self.target.read(command, size)
+    def write(self, command, data):
+        return self.target.write(command, data)
+    @property
+    def window(self):
+        # Serial until settled, so Lytro.transfer sends every chunk through readinto
+        return self.target.window if self.settled else 1
+    def readmany(self, requests):
+        if self.settled:
+            return self.target.readmany(requests)
+        # Unsettled: one chunk at a time, each measured by readinto
+        return lytro.Target.readmany(self, requests)
+    def readinto(self, command, buf):
+        if self.settled or command[0] != lytro.LytroDownload.command:
+            return self.target.readinto(command, buf)
+        # Sizes larger than the caller's buffer can't be measured with it
+        fitting = [size for size in self.candidates if size <= len(buf)]
+        if not fitting:
+            return self.target.readinto(command, buf)
+        size = fitting[0]
+        self.target.maxtransfer = size
+        start = time.perf_counter()
+        try:
+            received = self.target.readinto(command, buf)
+        except (IOError, AssertionError):
+            # Refused; forget this size and retry the chunk with the next one.
+            # A failed read can leave the stream out of step, so the retry
+            # needs a fresh connection; transports that can't make one give up.
+            self.drop(size)
+            reconnect = getattr(self.target, 'reconnect', None)
+            if reconnect is None:
+                raise
+            reconnect()
+            if self.settled:
+                if not self.results:
+                    raise
+                return self.target.readinto(command, buf)
+            return self.readinto(command, buf)
+        elapsed = time.perf_counter()-start
+        # Only full-size requests say anything about the chunk size
+        if len(buf) >= size and received:
+            result = self.results.setdefault(size, [0, 0.0, 0])
+            result[0] += received
+            result[1] += elapsed
+            result[2] += 1
+            if received < size:
+                # Camera caps chunks below this size; larger ones won't help
+                for larger in [c for c in self.candidates if c > size]:
+                    self.drop(larger)
+            if result[2] >= self.samples and not self.settled:
+                self.drop(size)
+        # Give up on sizes the buffers keep turning out too small for,
+        # e.g. iterdownload's chunk buffer
+        for larger in [c for c in self.candidates if c > len(buf)]:
+            self.skipped[larger] += 1
+            if self.skipped[larger] >= self.samples and not self.settled:
+                self.drop(larger)
+        return received
+    def drop(self, size):
+        "Done with a candidate size; settle once none are left"
+        self.candidates.remove(size)
+        if not self.candidates:
+            self.settle()
+    def throughput(self):
+        "Measured bytes/second per tried size"
+        return {size: received/elapsed for size, (received, elapsed, chunks) in self.results.items() if elapsed}
+    def settle(self):
+        rates = self.throughput()
+        best = max(rates, key=rates.get) if rates else self.target.transfersizes[0]
+        self.target.maxtransfer = best
+        self.settled = True
+        sizes = loadsizes(self.path)
+        sizes[self.key] = best
+        savesizes(sizes, self.path)
+
+def tune(dev, samples=3, path=cachefile):
+    "Make dev tune its transfer size, keyed by its serial. Returns the cached size, if known."
+    serial = dev.gethardwareinfo(verbose=False).serial.decode('ascii', 'backslashreplace')
+    dev.comm = TunedTarget(dev.comm, f"{serial}/{type(dev.comm).__name__}", samples, path)
+    return dev.comm.maxtransfer if dev.comm.settled else None